@@ -2,9 +2,11 @@
 """General command line tool for narchi package functionalities."""
 
 import sys
-from jsonargparse import ArgumentParser
-from jsonargparse.typing import Path_fr, Path_fc
+from jsonargparse import ArgumentParser, Namespace
+from typing import Optional
+from jsonargparse.typing import Path_fr, Path_fc, NonNegativeInt, PositiveInt
 from narchi.render import ModuleArchitecture, ModuleArchitectureRenderer
+from narchi.stats import ModuleArchitectureStats
 from narchi.schemas import schema_as_str, schemas
 from narchi import __version__
 
@@ -33,6 +35,42 @@ def get_parser():
         help='Path where to write the architecture diagram (with a valid extension for pygraphviz draw). If '
              'unset a pdf is saved to the output directory.')
 
+    ## stats parser ##
+    parser_stats = ModuleArchitectureStats.get_config_parser()
+    parser_stats.description = ('Command for printing parameters, operations, activation sizes and the activations '
+                                'memory plan of a neural network module architecture file.')
+    parser_stats.set_defaults(propagators='default')
+    parser_stats.add_argument('jsonnet_path',
+        type=Path_fr,
+        help='Path to a neural network module architecture file in jsonnet narchi format.')
+
+    ## profile parser ##
+    parser_profile = ModuleArchitecture.get_config_parser()
+    parser_profile.description = ('Command for profiling the forward of each block of a neural network module architecture '
+                                  'file with random inputs using the pytorch instantiator.')
+    parser_profile.set_defaults(propagators='default')
+    parser_profile.add_argument('--variables',
+        type=dict,
+        help='Values for variable dimensions of the random inputs.')
+    parser_profile.add_argument('--batch_size',
+        default=PositiveInt(1),
+        type=PositiveInt,
+        help='Batch size of the random inputs.')
+    parser_profile.add_argument('--repetitions',
+        default=PositiveInt(10),
+        type=PositiveInt,
+        help='Number of profiled forwards, preceded by a warm-up forward.')
+    parser_profile.add_argument('--nested_depth',
+        default=NonNegativeInt(0),
+        type=NonNegativeInt,
+        help='Maximum depth for nested blocks to include. Set to 0 for unlimited.')
+    parser_profile.add_argument('--top',
+        type=Optional[PositiveInt],
+        help='Maximum number of blocks to print.')
+    parser_profile.add_argument('jsonnet_path',
+        type=Path_fr,
+        help='Path to a neural network module architecture file in jsonnet narchi format.')
+
     ## schema parser ##
     parser_schema = ArgumentParser(
         description='Prints a schema as a pretty json.')
@@ -52,11 +90,15 @@ def get_parser():
         help='Whether to print stack trace when there are errors.')
     parser.parser_validate = parser_validate
     parser.parser_render = parser_render
+    parser.parser_stats = parser_stats
+    parser.parser_profile = parser_profile
     parser.parser_schema = parser_schema
 
     subcommands = parser.add_subcommands()
     subcommands.add_subcommand('validate', parser_validate)
     subcommands.add_subcommand('render', parser_render)
+    subcommands.add_subcommand('stats', parser_stats)
+    subcommands.add_subcommand('profile', parser_profile)
     subcommands.add_subcommand('schema', parser_schema)
 
     return parser
@@ -70,6 +112,14 @@ def get_render_parser():
     return get_parser().parser_render
 
 
+def get_stats_parser():
+    return get_parser().parser_stats
+
+
+def get_profile_parser():
+    return get_parser().parser_profile
+
+
 def get_schema_parser():
     return get_parser().parser_schema
 
@@ -99,6 +149,30 @@ def narchi_cli(argv=None):
             module = ModuleArchitectureRenderer(cfg=cfg.render, parser=parser.parser_render)
             module.render(architecture=cfg.render.jsonnet_path, out_render=cfg.render.out_file)
 
+        ## Stats subcommand ##
+        elif cfg.subcommand == 'stats':
+            module = ModuleArchitectureStats(cfg=cfg.stats, parser=parser.parser_stats)
+            module.load_architecture(cfg.stats.jsonnet_path)
+            print(module.stats_table())
+            print()
+            print(module.memory_summary())
+
+        ## Profile subcommand ##
+        elif cfg.subcommand == 'profile':
+            import torch
+            from narchi.instantiators.pytorch import StandardModule
+            cfg_profile = cfg.profile
+            module = StandardModule(cfg_profile.jsonnet_path, cfg=cfg_profile, parser=parser.parser_profile)
+            module.eval()
+            variables = vars(cfg_profile.variables) if isinstance(cfg_profile.variables, Namespace) else cfg_profile.variables
+            inputs = module.random_inputs(variables=variables, batch_size=cfg_profile.batch_size)
+            with torch.no_grad():
+                module(**inputs)
+                with module.profile() as profiler:
+                    for _ in range(cfg_profile.repetitions):
+                        module(**inputs)
+            print(profiler.table(nested_depth=cfg_profile.nested_depth, top=cfg_profile.top))
+
     except Exception as ex:
         if cfg.stack_trace:
             raise ex
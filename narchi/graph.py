@@ -68,3 +68,39 @@ def parse_graph(from_blocks: List[Namespace], block: Namespace) -> Dict[str, Lis
         raise ValueError(f'Graph in block[id={block._id}] does not reference all of its blocks: missing={missing}.')
 
     return topological_predecessors
+
+
+def get_needed_until(topological_predecessors: Dict[str, List[str]]) -> Dict[str, str]:
+    """Gets for each node the last node in topological order that requires it as input.
+
+    Args:
+        topological_predecessors: Dictionary in topological order mapping node IDs to its respective input nodes IDs.
+
+    Returns:
+        Dictionary mapping node IDs to the ID of the last node that requires it.
+    """
+    needed_until = OrderedDict()
+    for node, inputs in topological_predecessors.items():
+        for input in inputs:
+            needed_until[input] = node
+    return needed_until
+
+
+def get_level_sets(topological_predecessors: Dict[str, List[str]]) -> List[List[str]]:
+    """Groups nodes into levels such that nodes in a level only depend on nodes of previous levels.
+
+    Args:
+        topological_predecessors: Dictionary in topological order mapping node IDs to its respective input nodes IDs.
+
+    Returns:
+        List of levels, each a list of node IDs in topological order.
+    """
+    node_level = {}
+    levels = []
+    for node, inputs in topological_predecessors.items():
+        level = 1 + max((node_level.get(x, -1) for x in inputs), default=-1)
+        node_level[node] = level
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(node)
+    return levels
@@ -1,6 +1,8 @@
 """Generic code for module architecture instantiators."""
 
 import inspect
+from copy import deepcopy
+from typing import Dict
 from ..schemas import mappings_validator, id_separator
 from ..propagators.base import get_shape
 
@@ -17,53 +19,141 @@ def import_object(name):
     return getattr(module, name_class)
 
 
-def instantiate_block(block_cfg, blocks_mappings, module_cfg):
-    """Function that instantiates a block given its narchi config and a mappings object."""
-    mappings_validator.validate(blocks_mappings)
-    if block_cfg._class not in blocks_mappings:
-        raise NotImplementedError(f'No mapping for blocks of type {block_cfg._class}.')
+class BlockFactory:
+    """Instantiator of blocks of a single class compiled from a mapping.
 
-    kwargs = {k: v for k, v in vars(block_cfg).items() if not k.startswith('_')}
+    The kwargs transformations are parsed once, while the import of the class
+    and the inspection of its signature are done on first use and cached.
+    """
 
-    def set_kwargs(key_to, key_from, value=None):
-        if key_to in kwargs:
-            print(f'warning: mapping defines {key_to} as {key_from} so replacing current value: {kwargs[key_to]}.')
-        if value is None:
-            kwargs[key_to] = kwargs.pop(key_from)
-        else:
-            kwargs[key_to] = value
+    def __init__(self, block_mapping: dict):
+        """Initializer for BlockFactory class.
 
-    block_mapping = blocks_mappings[block_cfg._class]
-    block_class = import_object(block_mapping['class'])
-    if 'kwargs' in block_mapping:
-        for key_to, key_from in block_mapping['kwargs'].items():
+        Args:
+            block_mapping: The mapping for the class, i.e. a value of a validated blocks mappings.
+        """
+        self.class_path = block_mapping['class']
+        self._block_class = None
+        self._func_param = None
+        self.transforms = []
+        for key_to, key_from in block_mapping.get('kwargs', {}).items():
             if key_to == ':skip:':
-                del kwargs[key_from]
+                self.transforms.append(('skip', key_to, key_from, None))
             elif key_from[0] == '_':
-                set_kwargs(key_to, key_from, getattr(block_cfg, key_from))
+                self.transforms.append(('attr', key_to, key_from, None))
             elif key_from.startswith('shape:'):
                 _, key, idx = key_from.split(':')
-                set_kwargs(key_to, key_from, get_shape(key, block_cfg)[int(idx)])
+                self.transforms.append(('shape', key_to, key_from, (key, int(idx))))
             elif key_from.startswith('const:'):
                 _, vtype, val = key_from.split(':')
                 if vtype == 'int':
                     val = int(val)
                 elif vtype == 'bool':
                     val = False if val == 'False' else True
-                set_kwargs(key_to, key_from, val)
+                self.transforms.append(('const', key_to, key_from, val))
+            else:
+                self.transforms.append(('rename', key_to, key_from, None))
+
+
+    @property
+    def block_class(self):
+        """The class to instantiate, imported on first access."""
+        if self._block_class is None:
+            self._block_class = import_object(self.class_path)
+        return self._block_class
+
+
+    @property
+    def func_param(self):
+        """The names of the parameters of the class initializer."""
+        if self._func_param is None:
+            self._func_param = {x.name for x in inspect.signature(self.block_class).parameters.values()}
+        return self._func_param
+
+
+    def __call__(self, block_cfg, blocks_mappings, module_cfg, shared_blocks=None):
+        """Instantiates a block, see :func:`instantiate_block`."""
+        kwargs = {k: v for k, v in vars(block_cfg).items() if not k.startswith('_')}
+
+        def set_kwargs(key_to, key_from, value=None):
+            if key_to in kwargs:
+                print(f'warning: mapping defines {key_to} as {key_from} so replacing current value: {kwargs[key_to]}.')
+            if value is None:
+                kwargs[key_to] = kwargs.pop(key_from)
+            else:
+                kwargs[key_to] = value
+
+        for kind, key_to, key_from, value in self.transforms:
+            if kind == 'skip':
+                del kwargs[key_from]
+            elif kind == 'attr':
+                set_kwargs(key_to, key_from, getattr(block_cfg, key_from))
+            elif kind == 'shape':
+                set_kwargs(key_to, key_from, get_shape(value[0], block_cfg)[value[1]])
+            elif kind == 'const':
+                set_kwargs(key_to, key_from, value)
             else:
                 set_kwargs(key_to, key_from)
 
-    if block_cfg._class == 'Module':
-        set_kwargs('cfg', 'module_cfg', module_cfg)
+        if block_cfg._class == 'Module':
+            set_kwargs('cfg', 'module_cfg', module_cfg)
+
+        block_class = self.block_class
+        func_param = self.func_param
+        if 'blocks_mappings' in func_param:
+            set_kwargs('blocks_mappings', 'function_parameter', blocks_mappings)
+        if 'module_cfg' in func_param:
+            set_kwargs('module_cfg', 'function_parameter', module_cfg)
+        if 'shared_blocks' in func_param:
+            set_kwargs('shared_blocks', 'function_parameter', shared_blocks)
+
+        try:
+            return block_class(**kwargs)
+        except Exception as ex:
+            raise RuntimeError(f'Failed to instantiate block[id={block_cfg._id}, class={block_class}] with kwargs={kwargs}: {ex}') from ex
+
+
+_compiled_mappings = {}
+
+
+def compile_mappings(blocks_mappings: dict) -> Dict[str, BlockFactory]:
+    """Validates and compiles a blocks mappings object into per class factories.
+
+    Results are cached per mappings object. A copy of the mappings is kept so
+    that if the object is modified it is compiled again.
 
-    func_param = {x.name for x in inspect.signature(block_class).parameters.values()}
-    if 'blocks_mappings' in func_param:
-        set_kwargs('blocks_mappings', 'function_parameter', blocks_mappings)
-    if 'module_cfg' in func_param:
-        set_kwargs('module_cfg', 'function_parameter', module_cfg)
+    Args:
+        blocks_mappings: The blocks mappings object.
+
+    Returns:
+        Dictionary mapping block class names to BlockFactory objects.
+    """
+    key = id(blocks_mappings)
+    if key in _compiled_mappings:
+        mappings_copy, compiled = _compiled_mappings[key]
+        if mappings_copy == blocks_mappings:
+            return compiled
+    mappings_validator.validate(blocks_mappings)
+    compiled = {k: BlockFactory(v) for k, v in blocks_mappings.items()}
+    _compiled_mappings[key] = (deepcopy(blocks_mappings), compiled)
+    return compiled
+
+
+def instantiate_block(block_cfg, blocks_mappings, module_cfg, shared_blocks=None):
+    """Function that instantiates a block given its narchi config and a mappings object.
+
+    If shared_blocks is a dictionary, blocks with an _id_share already in it are
+    reused instead of instantiated, and new ones are added to it.
+    """
+    share = shared_blocks is not None and hasattr(block_cfg, '_id_share')
+    if share and block_cfg._id_share in shared_blocks:
+        return shared_blocks[block_cfg._id_share]
+
+    compiled = compile_mappings(blocks_mappings)
+    if block_cfg._class not in compiled:
+        raise NotImplementedError(f'No mapping for blocks of type {block_cfg._class}.')
 
-    try:
-        return block_class(**kwargs)
-    except Exception as ex:
-        raise RuntimeError(f'Failed to instantiate block[id={block_cfg._id}, class={block_class}] with kwargs={kwargs}: {ex}') from ex
+    block = compiled[block_cfg._class](block_cfg, blocks_mappings, module_cfg, shared_blocks=shared_blocks)
+    if share:
+        shared_blocks[block_cfg._id_share] = block
+    return block
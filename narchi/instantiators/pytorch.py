@@ -1,34 +1,81 @@
 """A standard module instantiator for pytorch."""
 
+import hashlib
+import os
+import threading
+import time
+import weakref
+import numpy as np
 import torch
+import torch.ao.nn.quantized.dynamic
+import torch.ao.quantization
+import torch.utils.checkpoint
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.nn.modules.conv import _ConvNd
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.overrides import TorchFunctionMode
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, nullcontext
+from fnmatch import fnmatchcase
 from functools import reduce
-from collections import OrderedDict
-from jsonargparse import Path, get_config_read_mode
-from typing import List
+from itertools import chain
+from collections import Counter, OrderedDict, namedtuple
+from jsonargparse import Namespace, Path, get_config_read_mode, namespace_to_dict
+from typing import Dict, Iterator, List, Tuple, Union
 
-from .common import instantiate_block, id_strip_parent_prefix
+from .common import compile_mappings, import_object, instantiate_block, id_strip_parent_prefix
 from ..module import ModuleArchitecture
 from ..propagators.reshape import check_reshape_spec, norm_reshape_spec
 from ..propagators.group import get_blocks_dict
-from ..graph import parse_graph
-from ..schemas import auto_tag
+from ..graph import parse_graph, get_needed_until, get_level_sets
+from ..schemas import auto_tag, id_separator
+from ..sympy import sympify_variable
 
 
 class BaseModule(ModuleArchitecture, torch.nn.Module):
     """Base class for instantiation of pytorch modules based on a narchi architecture."""
 
+    dynamic_quantized_classes = {
+        'Linear': 'torch.ao.nn.quantized.dynamic.Linear',
+        'LSTM': 'narchi.instantiators.pytorch.DynamicLSTM',
+        'GRU': 'narchi.instantiators.pytorch.DynamicGRU',
+    }
+    """Mapping of narchi block classes to dynamically quantized pytorch classes, used by :meth:`quantize`."""
+
+    channels_last_classes = {'Conv2d', 'BatchNorm2d', 'MaxPool2d', 'AvgPool2d', 'AdaptiveAvgPool2d', 'AdaptiveMaxPool2d'}
+    """Block classes whose 4D inputs are converted to channels_last, used by :meth:`set_memory_format`."""
+
+    contiguous_classes = {'Reshape', 'Linear', 'RNN', 'GRU', 'LSTM'}
+    """Block classes whose inputs are made contiguous, used by :meth:`set_memory_format`."""
+
     def __init__(
         self,
         *args,
         state_dict: dict = None,
         debug: bool = False,
+        meta: bool = False,
+        checkpoint_blocks: List[str] = None,
+        branch_threads: int = 1,
+        inplace: bool = False,
+        memory_format: str = None,
+        init_threads: int = None,
+        init_seed: int = None,
         **kwargs
     ):
         """Initializer for BaseModule class.
 
         Args:
-            state_dict: State dictionary to set.
+            state_dict: State dictionary (or path to one) to set. Blocks are then instantiated without random initialization.
             debug: Enable to keep self.intermediate_outputs.
+            meta: Enable to instantiate all blocks on the meta device, i.e. without allocating parameters. See :meth:`materialize`.
+            checkpoint_blocks: IDs or classes of blocks to checkpoint in addition to the ones with _checkpoint=true. See :meth:`set_checkpointing`.
+            branch_threads: Number of threads for running independent graph branches concurrently. See :meth:`set_branch_threads`.
+            inplace: Enable to run element-wise blocks in place when their input is no longer needed. See :meth:`set_inplace`.
+            memory_format: Either None or "channels_last". See :meth:`set_memory_format`.
+            init_threads: Number of threads for instantiating top-level blocks concurrently. Implies seeded initialization.
+            init_seed: Enable seeded initialization, i.e. the random generator of each top-level block is seeded from
+                init_seed and the block id, so parameters do not depend on the other blocks or on init_threads.
+                If None and init_threads is set, torch.initial_seed() is used.
             args/kwargs: All other arguments accepted by :class:`.ModuleArchitecture`.
         """
         torch.nn.Module.__init__(self)
@@ -37,16 +84,39 @@ class BaseModule(ModuleArchitecture, torch.nn.Module):
         architecture = self.architecture
         blocks = self.blocks
         module_cfg = {'propagated': True, 'cwd': self.cfg.cwd}
-        if 'cfg' in kwargs and 'ext_vars' in kwargs['cfg']:
-            module_cfg['ext_vars'] = kwargs['cfg']['ext_vars']
+        if self.cfg.ext_vars:
+            ext_vars = self.cfg.ext_vars
+            module_cfg['ext_vars'] = namespace_to_dict(ext_vars) if isinstance(ext_vars, Namespace) else ext_vars
 
         io_ids = {x._id for x in architecture.inputs+architecture.outputs}
 
-        for block_id in blocks.keys():
-            if block_id not in io_ids:
-                block = instantiate_block(blocks[block_id], self.blocks_mappings, module_cfg)
+        block_ids = [k for k in blocks.keys() if k not in io_ids]
+        if init_threads is not None and init_seed is None:
+            init_seed = torch.initial_seed()
+
+        def instantiate_blocks(meta):
+            shared_blocks = {}
+            if init_seed is None:
+                with torch.device('meta') if meta else nullcontext():
+                    instantiated = [instantiate_block(blocks[k], self.blocks_mappings, module_cfg, shared_blocks=shared_blocks) for k in block_ids]
+            else:
+                instantiated = instantiate_seeded_blocks(
+                    [blocks[k] for k in block_ids], self.blocks_mappings, module_cfg, shared_blocks, init_seed, init_threads or 1, meta)
+            for block_id, block in zip(block_ids, instantiated):
                 setattr(self, id_strip_parent_prefix(block_id), block)
 
+        ## When a state_dict is given, skip random initialization by instantiating on meta ##
+        instantiate_blocks(meta or state_dict is not None)
+
+        self.shared_aliases = get_shared_aliases(self)
+        self._register_state_dict_hook(shared_state_dict_hook)
+        self._register_load_state_dict_pre_hook(shared_load_state_dict_pre_hook, with_module=True)
+
+        self.set_checkpointing(checkpoint_blocks)
+        self.set_branch_threads(branch_threads)
+        self.set_inplace(inplace)
+        self.memory_format_hooks = []
+        self.set_memory_format(memory_format)
         self.state_dict_prop = state_dict
         self.debug = debug
 
@@ -97,6 +167,303 @@ class BaseModule(ModuleArchitecture, torch.nn.Module):
         return list(value.shape[1:])
 
 
+    def set_checkpointing(self, checkpoint_blocks: List[str] = None):
+        """Enables gradient checkpointing for blocks, i.e. their internals are recomputed in backward.
+
+        Blocks to checkpoint are the ones with _checkpoint=true in the architecture and the
+        ones whose _id or _class is in checkpoint_blocks. Checkpointing only takes place in
+        forwards with gradient enabled.
+
+        Args:
+            checkpoint_blocks: IDs or classes of blocks to checkpoint.
+
+        Raises:
+            ValueError: If a value in checkpoint_blocks does not match any block.
+        """
+        checkpoint_blocks = set(checkpoint_blocks or [])
+        matched = set()
+        for nested in named_blocks(self):
+            match = {nested.cfg._id, nested.cfg._class} & checkpoint_blocks
+            matched.update(match)
+            if match or getattr(nested.cfg, '_checkpoint', False):
+                nested.module.checkpointed = True
+        if checkpoint_blocks - matched:
+            raise ValueError(f'checkpoint_blocks values {checkpoint_blocks - matched} do not match any block id or class.')
+
+
+    def set_branch_threads(self, branch_threads: int):
+        """Sets the number of threads for running concurrently independent branches of graphs.
+
+        The graphs of the module and of all nested Group and Module blocks are executed by
+        level sets, i.e. all nodes whose inputs are available run concurrently in a thread
+        pool. Results are gathered in topological order so outputs are deterministic.
+        Nested graphs within a running branch are executed sequentially. The grad,
+        inference and autocast modes of the calling thread are applied in the workers.
+        Graphs with shared blocks (_id_share) are executed sequentially in training
+        mode, since concurrent forwards of a shared block, e.g. a BatchNorm, would
+        update its state in a nondeterministic order. The thread pools are owned by
+        the module, so they are released with it.
+
+        Args:
+            branch_threads: Number of threads, 1 for sequential execution.
+
+        Raises:
+            ValueError: If branch_threads is not a positive int.
+        """
+        if not isinstance(branch_threads, int) or branch_threads < 1:
+            raise ValueError(f'Expected branch_threads to be a positive int, got {branch_threads}.')
+        graphs = [self] + [n.module for n in named_blocks(self) if isinstance(n.module, (Group, BaseModule))]
+        for module in graphs:
+            module.branch_threads = branch_threads
+            module.has_shared_blocks = bool(get_shared_aliases(module))
+            executor = _branch_executors.pop(module, None)
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+
+    def set_inplace(self, inplace: bool):
+        """Sets whether element-wise blocks run in place when their input is no longer needed.
+
+        Applies to ReLU, LeakyReLU, Sigmoid, Tanh, Add and Dropout in eval mode, in
+        the module and in all nested Sequential, Group and Module blocks. An input
+        is overwritten only if no later block requires it, it is not an input or
+        output of the graph and it does not share memory with another alive value.
+        In-place is only used when grad is disabled, e.g. under torch.no_grad or
+        torch.inference_mode, since autograd may have saved the input for the
+        backward of another block. In-place is not used either when keeping
+        intermediate outputs (debug), for blocks with forward hooks nor for
+        nodes that run concurrently (see :meth:`set_branch_threads`).
+
+        Args:
+            inplace: Whether to enable in-place execution.
+        """
+        self.inplace = bool(inplace)
+        for nested in named_blocks(self):
+            if isinstance(nested.module, (Sequential, Group, BaseModule)):
+                nested.module.inplace = self.inplace
+
+
+    def set_memory_format(self, memory_format: str = None):
+        """Sets the memory format of the 4D parameters and activations.
+
+        For "channels_last", the 4D parameters (e.g. conv weights) are converted
+        once, and conversions of the activations are only inserted at the blocks
+        whose class is in :attr:`channels_last_classes` (to channels_last) or in
+        :attr:`contiguous_classes` (to contiguous), e.g. before a Reshape.
+
+        Args:
+            memory_format: Either None (contiguous) or "channels_last".
+
+        Raises:
+            ValueError: If memory_format is not one of the supported values.
+        """
+        if memory_format not in {None, 'channels_last'}:
+            raise ValueError(f'Expected memory_format to be one of None or "channels_last", got {memory_format}.')
+        for handle in self.memory_format_hooks:
+            handle.remove()
+        self.memory_format_hooks = []
+        self.memory_format = memory_format
+        if memory_format is None:
+            if not self.is_meta:
+                self.to(memory_format=torch.contiguous_format)
+            return
+        if not self.is_meta:
+            self.to(memory_format=torch.channels_last)
+        hooked = set()
+        for nested in named_blocks(self):
+            if id(nested.module) in hooked:
+                continue
+            if nested.cfg._class in self.channels_last_classes:
+                hook = channels_last_pre_hook
+            elif nested.cfg._class in self.contiguous_classes:
+                hook = contiguous_pre_hook
+            else:
+                continue
+            hooked.add(id(nested.module))
+            self.memory_format_hooks.append(nested.module.register_forward_pre_hook(hook))
+
+
+    def capture(self, patterns: List[str], sink: Union[str, Path] = 'memory') -> 'OutputsCapture':
+        """Returns a context manager that captures the outputs of selected blocks, see :class:`OutputsCapture`."""
+        return OutputsCapture(self, patterns, sink=sink)
+
+
+    def profile(self) -> 'BlocksProfiler':
+        """Returns a context manager that profiles the forward of all blocks, see :class:`BlocksProfiler`."""
+        return BlocksProfiler(self)
+
+
+    def random_inputs(self, variables: Dict[str, int] = None, batch_size: int = 1) -> Dict[str, torch.Tensor]:
+        """Creates random inputs for the module.
+
+        Inputs consumed by an Embedding block are random indexes, others are uniform in [0, 1).
+
+        Args:
+            variables: Values for the variable dimensions of the inputs.
+            batch_size: Size of the batch dimension.
+
+        Returns:
+            Dictionary of input tensors to give as keyword arguments to forward.
+
+        Raises:
+            ValueError: If a variable dimension has no value.
+        """
+        device = next(chain(self.parameters(), self.buffers())).device
+        inputs = {}
+        for node in self.architecture.inputs:
+            shape = [batch_size]
+            for dim in node._shape:
+                dim = sympify_variable(dim).subs(variables or {})
+                if not dim.is_number:
+                    raise ValueError(f'A value for {dim} is required to create input "{node._id}".')
+                shape.append(int(dim))
+            num_embeddings = self._get_num_embeddings(node._id)
+            if num_embeddings is None:
+                inputs[node._id] = torch.rand(*shape, device=device)
+            else:
+                inputs[node._id] = torch.randint(0, num_embeddings, shape, device=device)
+        return inputs
+
+
+    def _get_num_embeddings(self, input_id):
+        for node, inputs in self.topological_predecessors.items():
+            if input_id in inputs and node in self.blocks:
+                block = self.blocks[node]
+                while block._class == 'Sequential':
+                    block = block.blocks[0]
+                if block._class == 'Embedding':
+                    return block.num_embeddings
+        return None
+
+
+    def fuse_for_inference(self) -> int:
+        """Folds batch normalization blocks into the preceding convolutions.
+
+        Pairs are searched in the module and in all nested Sequential, Group and
+        Module blocks, i.e. consecutive blocks in a Sequential, or a graph node
+        whose only input is a convolution that has no other consumer and is not
+        an output. The fused convolution replaces the original and the batch
+        normalization is replaced by an Identity. Shared blocks are not fused.
+
+        Returns:
+            The number of fused pairs.
+
+        Raises:
+            RuntimeError: If the module is in training mode.
+        """
+        if self.training:
+            raise RuntimeError(f'{type(self).__name__} can only be fused for inference in eval mode.')
+        counts = Counter(id(m) for _, m in self.named_modules(remove_duplicate=False))
+        containers = OrderedDict([(id(self), self)])
+        for nested in named_blocks(self):
+            if isinstance(nested.module, (Sequential, Group, BaseModule)):
+                containers.setdefault(id(nested.module), nested.module)
+
+        num_fused = 0
+        for container in containers.values():
+            for conv_name, bn_name in conv_bn_pairs(container):
+                conv = getattr(container, conv_name)
+                bn = getattr(container, bn_name)
+                if counts[id(conv)] > 1 or counts[id(bn)] > 1 or not isinstance(conv, _ConvNd) or conv.transposed \
+                   or not isinstance(bn, _BatchNorm) or bn.running_mean is None or conv.out_channels != bn.num_features:
+                    continue
+                setattr(container, conv_name, fuse_conv_bn_eval(conv, bn))
+                setattr(container, bn_name, torch.nn.Identity())
+                num_fused += 1
+        return num_fused
+
+
+    def quantize(
+        self,
+        include: List[str] = None,
+        exclude: List[str] = None,
+        dtype: torch.dtype = torch.qint8,
+    ) -> int:
+        """Applies dynamic quantization to blocks, i.e. weights are quantized and activations quantized on the fly.
+
+        The supported block classes are the keys of :attr:`dynamic_quantized_classes`.
+        Blocks are replaced in place, thus the module can only be used for inference.
+
+        Args:
+            include: IDs or classes of blocks to quantize. If None all blocks with a supported class.
+            exclude: IDs or classes of blocks not to quantize.
+            dtype: Either torch.qint8 or torch.float16.
+
+        Returns:
+            The number of quantized blocks.
+
+        Raises:
+            RuntimeError: If the module is in training mode.
+            NotImplementedError: If an included block has a class not supported.
+            ValueError: If an include or exclude value does not match any block.
+        """
+        if self.training:
+            raise RuntimeError(f'{type(self).__name__} can only be quantized in eval mode.')
+        if dtype not in {torch.qint8, torch.float16}:
+            raise ValueError(f'Expected dtype to be one of torch.qint8 or torch.float16, got {dtype}.')
+        include = None if include is None else set(include)
+        exclude = set(exclude or [])
+        matched = set()
+        quantized = {}
+        for nested in list(named_blocks(self)):
+            keys = {nested.cfg._id, nested.cfg._class}
+            matched.update(keys & ((include or set()) | exclude))
+            if keys & exclude or (include is None and nested.cfg._class not in self.dynamic_quantized_classes):
+                continue
+            if include is not None and not keys & include:
+                continue
+            if nested.cfg._class not in self.dynamic_quantized_classes:
+                raise NotImplementedError(f'Dynamic quantization not supported for block[id={nested.cfg._id}] of class {nested.cfg._class}.')
+            if id(nested.module) not in quantized:
+                quantized_class = import_object(self.dynamic_quantized_classes[nested.cfg._class])
+                quantized[id(nested.module)] = dynamic_quantize_block(nested.module, quantized_class, dtype)
+            setattr(nested.parent, nested.name, quantized[id(nested.module)])
+        unmatched = ((include or set()) | exclude) - matched
+        if unmatched:
+            raise ValueError(f'quantize include/exclude values {unmatched} do not match any block id or class.')
+        return len(quantized)
+
+
+    @property
+    def is_meta(self) -> bool:
+        """Whether the module has parameters or buffers on the meta device."""
+        return any(x.is_meta for x in chain(self.parameters(), self.buffers()))
+
+
+    def materialize(
+        self,
+        device: Union[str, torch.device] = 'cpu',
+        state_dict: Union[dict, str, Path] = None,
+    ):
+        """Allocates the parameters and buffers of a module instantiated on the meta device.
+
+        Non-persistent buffers, which are not part of state dictionaries, are set
+        by instantiating only the blocks that have them, see :func:`get_non_persistent_buffers`.
+
+        Args:
+            device: Device on which to allocate the tensors.
+            state_dict: State dictionary (or path to one) from which to set the values. If None parameters are initialized.
+
+        Raises:
+            RuntimeError: If state_dict is None and a block with parameters does not implement reset_parameters.
+        """
+        non_persistent_buffers = get_non_persistent_buffers(self)
+        self.to_empty(device=device)
+        if self.memory_format is not None:
+            self.to(memory_format=getattr(torch, self.memory_format))
+        with torch.no_grad():
+            for key, value in non_persistent_buffers.items():
+                self.get_buffer(key).copy_(value)
+        if state_dict is not None:
+            self.state_dict_prop = state_dict
+            return
+        for module in self.modules():
+            if hasattr(module, 'reset_parameters'):
+                module.reset_parameters()
+            elif any(True for _ in chain(module.parameters(recurse=False), module.buffers(recurse=False))):
+                raise RuntimeError(f'Unable to initialize {type(module).__name__} since it does not implement reset_parameters.')
+
+
     @property
     def state_dict_prop(self):
         """The current state dictionary."""
@@ -104,30 +471,320 @@ class BaseModule(ModuleArchitecture, torch.nn.Module):
 
 
     @state_dict_prop.setter
-    def state_dict_prop(self, state_dict: dict):
+    def state_dict_prop(self, state_dict: Union[dict, str, Path]):
         """Replaces the current state dictionary with the one given.
 
+        Checkpoint files are memory-mapped when possible, thus tensors are read
+        while being copied into the parameters.
+
         Args:
-            state_dict: State dictionary to set.
+            state_dict: State dictionary to set, or a path to a checkpoint file or to a directory
+                of shards as saved by :meth:`save_sharded_state_dict`.
         """
         if state_dict is None:
             return
-        elif isinstance(state_dict, (str, Path)):
-            path = Path(state_dict, mode=get_config_read_mode(), cwd=self.cfg.cwd)
-            state_dict = torch.load(path(), weights_only=True)
+        if self.is_meta:
+            self.materialize(state_dict=state_dict)
+            return
+        if isinstance(state_dict, (str, Path)):
+            try:
+                path = Path(state_dict, mode='dr', cwd=self.cfg.cwd)
+            except TypeError:
+                path = Path(state_dict, mode=get_config_read_mode(), cwd=self.cfg.cwd)
+                state_dict = load_checkpoint(path())
+            else:
+                self.load_sharded_state_dict(path())
+                return
         if not isinstance(state_dict, dict):
             raise ValueError('Expected state_dict to be a dictionary.')
-
         self.load_state_dict(state_dict)
 
 
+    def save_sharded_state_dict(self, path: str):
+        """Saves the state dictionary split by top-level block ids as {path}/{block_id}.pth files.
+
+        Args:
+            path: Directory where to save the shards, created if it does not exist.
+        """
+        os.makedirs(path, exist_ok=True)
+        shards = OrderedDict()
+        for key, value in self.state_dict().items():
+            block_id, block_key = key.split('.', 1)
+            shards.setdefault(block_id, OrderedDict())[block_key] = value
+        for block_id, shard in shards.items():
+            torch.save(shard, os.path.join(path, f'{block_id}.pth'))
+
+
+    def load_sharded_state_dict(self, path: str):
+        """Loads a state dictionary saved by :meth:`save_sharded_state_dict` one shard at a time.
+
+        Args:
+            path: Directory with the shards.
+
+        Raises:
+            RuntimeError: If a shard is missing or has keys not in the module.
+        """
+        expected = OrderedDict()
+        for key in self.state_dict().keys():
+            expected.setdefault(key.split('.', 1)[0], set()).add(key)
+        for block_id, keys in expected.items():
+            shard_path = os.path.join(path, f'{block_id}.pth')
+            if not os.path.isfile(shard_path):
+                raise RuntimeError(f'Missing shard for block[id={block_id}]: {shard_path}')
+            shard = {f'{block_id}.{k}': v for k, v in load_checkpoint(shard_path).items()}
+            if set(shard.keys()) != keys:
+                raise RuntimeError(f'Shard for block[id={block_id}] has missing keys {keys-set(shard.keys())} and '
+                                   f'unexpected keys {set(shard.keys())-keys}.')
+            self.load_state_dict(shard, strict=False)
+            del shard
+
+
+    def load_blocks_state_dict(
+        self,
+        state_dict: Union[dict, str, Path],
+        blocks: List[str] = None,
+        remap: Dict[str, str] = None,
+    ) -> 'BlocksLoadResult':
+        """Loads the parameters and buffers of a subset of blocks, optionally taken from differently named blocks.
+
+        Only the tensors of the selected blocks are read from the source, thus
+        when given a checkpoint path, which is memory-mapped when possible, the
+        rest of the file is not loaded into memory.
+
+        Usage:
+            module.load_blocks_state_dict('resnet.pth', ['image_features·*'], remap={'image_features': 'features'})
+
+        Args:
+            state_dict: Source state dictionary or path to a checkpoint file.
+            blocks: Block ids or glob patterns (fnmatch) of ids of this module to load, all if None.
+            remap: Mapping from block id prefixes in this module to block id prefixes in the source, an empty prefix being the root.
+
+        Returns:
+            The ids of loaded and missing blocks, and the source keys within the remapped blocks that were not used.
+
+        Raises:
+            ValueError: If the module is on the meta device, a pattern does not match any block or a selected key is not within a block.
+        """
+        if self.is_meta:
+            raise ValueError('Module on the meta device, materialize it before loading blocks.')
+        if isinstance(state_dict, (str, Path)):
+            state_dict = load_checkpoint(Path(state_dict, mode=get_config_read_mode(), cwd=self.cfg.cwd)())
+        remap = sorted(((k.replace(id_separator, '.'), v.replace(id_separator, '.')) for k, v in (remap or {}).items()),
+                       key=lambda x: -len(x[0]))
+
+        def source_key(key):
+            for prefix, source_prefix in remap:
+                if key_in_prefix(key, prefix):
+                    return '.'.join(x for x in [source_prefix, key[len(prefix):].lstrip('.')] if x)
+            return key
+
+        block_paths = OrderedDict()
+        selected = []
+        if blocks is None:
+            blocks = ['*']
+        unmatched = set(blocks)
+        for nested in named_blocks(self):
+            path = nested.cfg._id.replace(id_separator, '.')
+            block_paths[path] = nested.cfg._id
+            match = {p for p in blocks if fnmatchcase(nested.cfg._id, p)}
+            if match:
+                unmatched -= match
+                if not any(key_in_prefix(path, x) for x in selected):
+                    selected.append(path)
+        if unmatched:
+            raise ValueError(f'Load patterns {unmatched} do not match any block id.')
+
+        loaded = OrderedDict()
+        missing = OrderedDict()
+        selected_state_dict = OrderedDict()
+        for key in self.state_dict().keys():
+            if not any(key_in_prefix(key, x) for x in selected):
+                continue
+            path = key.rsplit('.', 1)[0]
+            while path not in block_paths and '.' in path:
+                path = path.rsplit('.', 1)[0]
+            if path not in block_paths:
+                raise ValueError(f'State dictionary key {key} is not within any block.')
+            block_id = block_paths[path]
+            source = source_key(key)
+            if source in state_dict:
+                selected_state_dict[key] = state_dict[source]
+                loaded[block_id] = True
+            else:
+                missing[block_id] = True
+        self.load_state_dict(selected_state_dict, strict=False)
+
+        used = {source_key(k) for k in selected_state_dict.keys()}
+        source_prefixes = {source_key(x) for x in selected}
+        unexpected = [k for k in state_dict.keys() if k not in used and any(key_in_prefix(k, x) for x in source_prefixes)]
+        return BlocksLoadResult([k for k in loaded if k not in missing], list(missing), unexpected)
+
+
+class BlocksLoadResult(namedtuple('BlocksLoadResult', 'loaded missing unexpected')):
+    """Named tuple returned by :meth:`BaseModule.load_blocks_state_dict`: ids of fully loaded blocks, ids of blocks with missing tensors and unused source keys."""
+
+
+def get_non_persistent_buffers(module: BaseModule) -> Dict[str, torch.Tensor]:
+    """Instantiates on the CPU the leaf blocks of a module that have non-persistent buffers and returns these buffers.
+
+    Args:
+        module: The module, possibly on the meta device.
+
+    Returns:
+        Dictionary mapping the dot-separated paths of the buffers to their values.
+    """
+    module_cfg = {'propagated': True, 'cwd': module.cfg.cwd}
+    buffers = OrderedDict()
+    for nested in named_blocks(module):
+        if isinstance(nested.module, (Sequential, Group, BaseModule)) or not any(m._non_persistent_buffers_set for m in nested.module.modules()):
+            continue
+        with torch.device('cpu'):
+            block = instantiate_block(nested.cfg, module.blocks_mappings, module_cfg)
+        prefix = nested.cfg._id.replace(id_separator, '.')
+        for name, submodule in block.named_modules():
+            for buffer in submodule._non_persistent_buffers_set:
+                buffers['.'.join(x for x in [prefix, name, buffer] if x)] = getattr(submodule, buffer)
+    return buffers
+
+
+def key_in_prefix(key: str, prefix: str) -> bool:
+    """Checks whether a dot-separated state dictionary key or module path is equal to or within a prefix, empty being the root."""
+    return not prefix or key == prefix or key.startswith(prefix+'.')
+
+
+def load_checkpoint(path: str) -> dict:
+    """Loads a checkpoint with weights_only, memory-mapped if the file format and torch version support it."""
+    try:
+        return torch.load(path, weights_only=True, mmap=True)
+    except (RuntimeError, TypeError):
+        return torch.load(path, weights_only=True)
+
+
+class SeededRandomMode(TorchFunctionMode):
+    """Torch function mode that makes random in-place initializations and factories use a given generator.
+
+    Torch function modes are thread-local, thus each thread can initialize blocks
+    with its own generator. The torch.nn.init functions are included since the
+    mode does not see the operations they call internally.
+    """
+
+    random_functions = {
+        torch.nn.init.uniform_, torch.nn.init.normal_, torch.nn.init.trunc_normal_, torch.nn.init.xavier_uniform_,
+        torch.nn.init.xavier_normal_, torch.nn.init.kaiming_uniform_, torch.nn.init.kaiming_normal_,
+        torch.nn.init.orthogonal_, torch.nn.init.sparse_,
+        torch.Tensor.uniform_, torch.Tensor.normal_, torch.Tensor.random_, torch.Tensor.bernoulli_,
+        torch.Tensor.exponential_, torch.Tensor.geometric_, torch.Tensor.log_normal_, torch.Tensor.cauchy_,
+        torch.rand, torch.randn, torch.randint, torch.randperm, torch.normal, torch.bernoulli, torch.multinomial,
+    }
+
+    def __init__(self, generator: torch.Generator):
+        super().__init__()
+        self.generator = generator
+
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if func in self.random_functions and kwargs.get('generator') is None:
+            kwargs['generator'] = self.generator
+        return func(*args, **kwargs)
+
+
+def block_seed(init_seed: int, block_id: str) -> int:
+    """Derives a deterministic 63-bit seed for a block from a base seed and the block id."""
+    digest = hashlib.sha256(f'{init_seed}:{block_id}'.encode()).digest()
+    return int.from_bytes(digest[:8], 'little') & (2**63 - 1)
+
+
+def has_shared_blocks(block_cfg) -> bool:
+    """Checks whether a block config or any of its nested blocks has an _id_share."""
+    if hasattr(block_cfg, '_id_share'):
+        return True
+    return any(has_shared_blocks(b) for b in getattr(block_cfg, 'blocks', None) or [])
+
+
+def instantiate_seeded_blocks(blocks_cfg, blocks_mappings, module_cfg, shared_blocks, init_seed, num_threads, meta=False) -> list:
+    """Instantiates blocks each with a random generator seeded by :func:`block_seed`, optionally in a thread pool.
+
+    Blocks that have shared blocks are instantiated sequentially and in order
+    after the rest, so which one creates each shared block is deterministic.
+
+    Returns:
+        The instantiated blocks in the same order as blocks_cfg.
+    """
+    compile_mappings(blocks_mappings)
+
+    def instantiate(block_cfg):
+        with torch.device('meta') if meta else nullcontext():
+            if meta:
+                return instantiate_block(block_cfg, blocks_mappings, module_cfg, shared_blocks=shared_blocks)
+            generator = torch.Generator().manual_seed(block_seed(init_seed, block_cfg._id))
+            with SeededRandomMode(generator):
+                return instantiate_block(block_cfg, blocks_mappings, module_cfg, shared_blocks=shared_blocks)
+
+    shared = [has_shared_blocks(b) for b in blocks_cfg]
+    independent = [b for b, s in zip(blocks_cfg, shared) if not s]
+    if num_threads > 1 and len(independent) > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            instantiated = list(executor.map(instantiate, independent))
+    else:
+        instantiated = [instantiate(b) for b in independent]
+    instantiated = iter(instantiated)
+    return [instantiate(b) if s else next(instantiated) for b, s in zip(blocks_cfg, shared)]
+
+
+def get_shared_aliases(module: torch.nn.Module) -> List[Tuple[str, str]]:
+    """Gets the names by which shared submodules are reachable more than once.
+
+    Returns:
+        List of (alias, name) tuples, where name is the first name of the submodule.
+    """
+    names = {}
+    aliases = []
+    for name, submodule in module.named_modules(remove_duplicate=False):
+        if id(submodule) not in names:
+            names[id(submodule)] = name
+        elif not any(name.startswith(alias+'.') for alias, _ in aliases):
+            aliases.append((name, names[id(submodule)]))
+    return aliases
+
+
+def shared_state_dict_hook(module, state_dict, prefix, local_metadata):
+    """State dict hook that removes the duplicate entries of shared submodules."""
+    for alias, _ in module.shared_aliases:
+        alias_prefix = prefix+alias+'.'
+        for key in [k for k in state_dict.keys() if k.startswith(alias_prefix)]:
+            del state_dict[key]
+
+
+def shared_load_state_dict_pre_hook(module, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+    """Load state dict pre-hook that adds the entries of shared submodules removed by shared_state_dict_hook."""
+    for alias, name in module.shared_aliases:
+        name_prefix = prefix+name+'.'
+        for key in [k for k in state_dict.keys() if k.startswith(name_prefix)]:
+            alias_key = prefix+alias+'.'+key[len(name_prefix):]
+            if alias_key not in state_dict:
+                state_dict[alias_key] = state_dict[key]
+
+
 class Sequential(torch.nn.Sequential):
     """Sequential module that receives as input an narchi blocks object."""
-    def __init__(self, blocks, blocks_mappings, module_cfg):
+    def __init__(self, blocks, blocks_mappings, module_cfg, shared_blocks=None):
         subblock_list = []
         for subblock in blocks:
-            subblock_list.append(instantiate_block(subblock, blocks_mappings, module_cfg))
+            subblock_list.append(instantiate_block(subblock, blocks_mappings, module_cfg, shared_blocks=shared_blocks))
         super().__init__(*subblock_list)
+        self.blocks = blocks
+
+    def forward(self, input):
+        inplace = getattr(self, 'inplace', False)
+        if inplace:
+            protected = storage_ptr(input)
+        for module in self:
+            result = None
+            if inplace and isinstance(input, torch.Tensor) and storage_ptr(input) != protected:
+                result = inplace_forward(module, [input], [True])
+            input = block_forward(module, input) if result is None else result
+        return input
 
 
 class Add(torch.nn.Module):
@@ -169,6 +826,40 @@ class LSTM(BaseRNN, torch.nn.LSTM):
     """Extension of torch.nn.LSTM that allows disabling the return of the hidden and cell states."""
 
 
+class DynamicLSTM(BaseRNN, torch.ao.nn.quantized.dynamic.LSTM):
+    """Extension of the dynamically quantized LSTM that allows disabling the return of the hidden and cell states."""
+
+
+class DynamicGRU(BaseRNN, torch.ao.nn.quantized.dynamic.GRU):
+    """Extension of the dynamically quantized GRU that allows disabling the return of the hidden state."""
+
+
+def dynamic_quantize_block(block, quantized_class, dtype=torch.qint8):
+    """Creates a dynamically quantized version of a Linear, LSTM or GRU block (including subclasses).
+
+    Args:
+        block: The float block to quantize.
+        quantized_class: The target class, either a torch dynamic quantized class or a subclass of one.
+        dtype: Either torch.qint8 or torch.float16.
+    """
+    if isinstance(block, torch.nn.RNNBase):
+        float_block = getattr(torch.nn, block.mode)(block.input_size, block.hidden_size, block.num_layers, block.bias,
+                                                   block.batch_first, block.dropout, block.bidirectional)
+    elif isinstance(block, torch.nn.Linear):
+        float_block = torch.nn.Linear(block.in_features, block.out_features, block.bias is not None)
+    else:
+        raise NotImplementedError(f'Dynamic quantization not supported for {type(block).__name__}.')
+    float_block.load_state_dict(block.state_dict())
+    float_block.qconfig = torch.ao.quantization.default_dynamic_qconfig if dtype == torch.qint8 else torch.ao.quantization.float16_dynamic_qconfig
+    base_class = next(c for c in quantized_class.__mro__ if c.__module__.startswith('torch.ao.nn.quantized.dynamic'))
+    quantized = base_class.from_float(float_block)
+    if quantized_class is not base_class:
+        quantized.__class__ = quantized_class
+        if isinstance(quantized, BaseRNN):
+            quantized.output_state = getattr(block, 'output_state', True)
+    return quantized
+
+
 class Reshape(torch.nn.Module):
     """Reshape module configurable by a narchi reshape_spec object."""
 
@@ -222,7 +913,7 @@ class Reshape(torch.nn.Module):
 class Group(torch.nn.Module):
     """Group module that receives narchi blocks, graph, input and output objects."""
 
-    def __init__(self, block_id, blocks, blocks_mappings, module_cfg, graph, input, output):
+    def __init__(self, block_id, blocks, blocks_mappings, module_cfg, graph, input, output, shared_blocks=None):
         super().__init__()
 
         from_input = block_id+'¦input'
@@ -236,7 +927,7 @@ class Group(torch.nn.Module):
 
         for num in range(len(blocks)):
             block_id = id_strip_parent_prefix(blocks[num]._id)
-            block = instantiate_block(blocks[num], blocks_mappings, module_cfg)
+            block = instantiate_block(blocks[num], blocks_mappings, module_cfg, shared_blocks=shared_blocks)
             setattr(self, block_id, block)
 
 
@@ -248,42 +939,439 @@ class Group(torch.nn.Module):
         return values[self.output]
 
 
-def graph_forward(module, values, out_ids=set(), intermediate_outputs=False):
-    """Runs a forward for a module using its graph topological_predecessors."""
+class OutputsCapture:
+    """Context manager that captures the outputs of selected blocks using forward hooks.
 
-    if intermediate_outputs and not hasattr(module, 'intermediate_outputs'):
-        module.intermediate_outputs = OrderedDict()
+    Only the outputs of the selected blocks are kept, so it is an alternative to
+    the debug mode of :class:`BaseModule` for large inputs. Blocks shared by
+    several ids (_id_share) are hooked once and captured under the _id_share.
+    For outputs that are not tensors, e.g. packed sequences or RNN outputs with
+    state, the data tensor is captured.
 
-    needed_until = OrderedDict()
-    for node, inputs in module.topological_predecessors.items():
-        for input in inputs:
-            needed_until[input] = node
+    Usage:
+        with module.capture(['conv?', 'fc'], sink='cpu') as capture:
+            module(image=image)
+        capture.outputs['fc']
+    """
 
-    for node, inputs in module.topological_predecessors.items():
-        if node in out_ids:
-            values[node] = values[inputs[0]]
-            continue
+    def __init__(self, module: BaseModule, patterns: List[str], sink: Union[str, Path] = 'memory'):
+        """Initializer for OutputsCapture class.
 
-        submodule = getattr(module, id_strip_parent_prefix(node))
-        try:
-            if isinstance(submodule, BaseModule):
-                assert len(inputs) == 1
-                assert len(submodule.architecture.inputs) == 1
-                result = submodule(**{submodule.architecture.inputs[0]._id: next(iter(values.values()))})
-            else:
-                result = submodule(*[values[x] for x in inputs])
-        except Exception as ex:
-            raise type(ex)(f'{type(submodule).__name__}[id={node}]: {ex}') from ex
-        #from torchvision.utils import save_image
-        #torch.save(result, f'/tmp/new_{node}.pth')
-        values[node] = result
+        Args:
+            module: The module whose blocks to capture.
+            patterns: Block ids or glob patterns (fnmatch) of ids.
+            sink: Where to capture: "memory" (same device, keeping autograd), "cpu" (detached copy) or
+                a directory path to which to stream each output as a {id}.{num}.npy file. Floating point
+                dtypes not supported by numpy, e.g. bfloat16, are saved as float32.
+
+        Raises:
+            ValueError: If a pattern does not match any block.
+        """
+        if sink not in {'memory', 'cpu'}:
+            sink = Path(sink, mode='dw')
+        self.sink = sink
+        self.outputs: Dict[str, list] = OrderedDict()
+        self.handles = []
+
+        matched = OrderedDict()
+        unmatched = set(patterns)
+        for nested in named_blocks(module):
+            match = {p for p in patterns if fnmatchcase(nested.cfg._id, p)}
+            if match:
+                unmatched -= match
+                key = getattr(nested.cfg, '_id_share', nested.cfg._id)
+                matched.setdefault(id(nested.module), (key, nested.module))
+        if unmatched:
+            raise ValueError(f'Capture patterns {unmatched} do not match any block id.')
+        for key, submodule in matched.values():
+            self.outputs[key] = []
+            self.handles.append(submodule.register_forward_hook(self._get_hook(key)))
+
+
+    def _get_hook(self, key):
+        def hook(module, inputs, output):
+            self.outputs[key].append(self._sink_value(key, output))
+        return hook
+
+
+    def _sink_value(self, key, output):
+        if isinstance(output, (tuple, list)) and not isinstance(output, torch.Tensor) and not hasattr(output, 'data'):
+            output = output[0]
+        if not isinstance(output, torch.Tensor):
+            output = output.data
+        if self.sink == 'memory':
+            return output.clone()
+        output = output.detach().to('cpu', copy=True)
+        if self.sink == 'cpu':
+            return output
+        if output.is_floating_point() and output.dtype not in {torch.float16, torch.float32, torch.float64}:
+            output = output.float()  # e.g. bfloat16, not supported by numpy
+        path = os.path.join(self.sink(), f'{key}.{len(self.outputs[key])}.npy')
+        np.save(path, output.numpy())
+        return np.load(path, mmap_mode='r')
+
+
+    def remove(self):
+        """Removes the forward hooks."""
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.remove()
+
+
+class BlocksProfiler:
+    """Context manager that profiles the forward of all the blocks of a module using forward hooks.
+
+    For each block id, including nested ones, it records the number of calls, the
+    wall and CPU (process) times, the output bytes and the output shape. Times of
+    blocks with nested blocks include the ones of their nested blocks. The forward
+    of each block is also labeled with its id for torch.profiler traces via
+    record_function. Blocks shared by several ids (_id_share) are recorded under
+    the _id_share. Note that blocks with hooks do not run in place.
+
+    The output bytes are the summed sizes of the output tensors, not allocated
+    memory: temporaries and workspaces are not included and views are counted
+    in full. For allocations per block, run inside torch.profiler.profile with
+    profile_memory=True and read the cpu_memory_usage (or the device memory usage)
+    of its key_averages() entries for the block ids.
+
+    Usage:
+        with module.profile() as profiler:
+            module(**module.random_inputs({'W': 128}))
+        print(profiler.table())
+    """
+
+    def __init__(self, module: BaseModule):
+        """Initializer for BlocksProfiler class.
+
+        Args:
+            module: The module whose blocks to profile.
+        """
+        self.records: Dict[str, dict] = OrderedDict()
+        self.handles = []
+        self.running = threading.local()
+
+        hooked = set()
+        for nested in named_blocks(module):
+            if id(nested.module) in hooked:
+                continue
+            hooked.add(id(nested.module))
+            key = getattr(nested.cfg, '_id_share', nested.cfg._id)
+            self.records[key] = {
+                'id': key,
+                'class': nested.cfg._class,
+                'depth': nested.cfg._id.count(id_separator),
+                'calls': 0,
+                'wall_time': 0.0,
+                'cpu_time': 0.0,
+                'output_bytes': 0,
+                'output_shape': None,
+            }
+            self.handles.append(nested.module.register_forward_pre_hook(self._get_pre_hook(key)))
+            self.handles.append(nested.module.register_forward_hook(self._get_hook(key), always_call=True))
+
+
+    def _get_pre_hook(self, key):
+        def pre_hook(module, inputs):
+            if not hasattr(self.running, 'stack'):
+                self.running.stack = []
+            record = torch.autograd.profiler.record_function(key)
+            record.__enter__()
+            self.running.stack.append((record, time.perf_counter(), time.process_time()))
+        return pre_hook
+
+
+    def _get_hook(self, key):
+        def hook(module, inputs, output):
+            record, wall_start, cpu_start = self.running.stack.pop()
+            stats = self.records[key]
+            stats['wall_time'] += time.perf_counter() - wall_start
+            stats['cpu_time'] += time.process_time() - cpu_start
+            record.__exit__(None, None, None)
+            stats['calls'] += 1
+            if isinstance(output, (tuple, list)) and not hasattr(output, 'data'):
+                output = output[0]
+            if not isinstance(output, torch.Tensor) and isinstance(getattr(output, 'data', None), torch.Tensor):
+                output = output.data
+            if isinstance(output, torch.Tensor):
+                stats['output_bytes'] += output.numel()*output.element_size()
+                stats['output_shape'] = list(output.shape)
+        return hook
+
+
+    def table(self, nested_depth: int = 0, top: int = None) -> str:
+        """Returns the records sorted by wall time formatted as a table.
+
+        Args:
+            nested_depth: Maximum depth of nested blocks to include, 0 for unlimited.
+            top: Maximum number of blocks to include.
+        """
+        rows = [r for r in self.records.values() if r['calls'] > 0 and (nested_depth == 0 or r['depth'] < nested_depth)]
+        rows = sorted(rows, key=lambda r: -r['wall_time'])[:top]
+        header = ['id', 'class', 'calls', 'wall_ms', 'cpu_ms', 'output_bytes', 'output_shape']
+        lines = [header]
+        for row in rows:
+            lines.append([row['id'], row['class'], str(row['calls']), f'{1000*row["wall_time"]:.3f}', f'{1000*row["cpu_time"]:.3f}',
+                          str(row['output_bytes']), str(row['output_shape'])])
+        widths = [max(len(line[n]) for line in lines) for n in range(len(header))]
+        return '\n'.join('  '.join(v.ljust(w) for v, w in zip(line, widths)).rstrip() for line in lines)
+
+
+    def remove(self):
+        """Removes the forward hooks and exits the record_function ranges left running in this thread."""
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        stack = getattr(self.running, 'stack', [])
+        while stack:
+            stack.pop()[0].__exit__(None, None, None)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.remove()
+
+
+def channels_last_pre_hook(module, inputs):
+    """Forward pre-hook that converts 4D input tensors to channels_last."""
+    return tuple(x.contiguous(memory_format=torch.channels_last) if isinstance(x, torch.Tensor) and x.dim() == 4 else x for x in inputs)
+
+
+def contiguous_pre_hook(module, inputs):
+    """Forward pre-hook that makes input tensors contiguous."""
+    return tuple(x.contiguous() if isinstance(x, torch.Tensor) else x for x in inputs)
+
+
+def conv_bn_pairs(module) -> List[Tuple[str, str]]:
+    """Gets attribute names of consecutive blocks in a Sequential or graph that are candidates for fusion.
+
+    For graphs, the first of a pair has a single consumer (outputs count as consumers) and is not an input.
+    """
+    if isinstance(module, Sequential):
+        return [(str(n), str(n+1)) for n in range(len(module)-1)]
+    topological_predecessors = module.topological_predecessors
+    consumers = Counter(chain.from_iterable(topological_predecessors.values()))
+    excluded = {module.input} if isinstance(module, Group) else {x._id for x in module.architecture.inputs+module.architecture.outputs}
+    pairs = []
+    for node, inputs in topological_predecessors.items():
+        if node not in excluded and len(inputs) == 1 and inputs[0] not in excluded and consumers[inputs[0]] == 1:
+            pairs.append((id_strip_parent_prefix(inputs[0]), id_strip_parent_prefix(node)))
+    return pairs
+
+
+class NestedBlock(namedtuple('NestedBlock', 'cfg module parent name')):
+    """Named tuple for a nested block: its narchi config, its pytorch module, the parent pytorch module and its name in the parent."""
+
+
+def named_blocks(module: torch.nn.Module) -> Iterator[NestedBlock]:
+    """Iterates depth-first over all the nested blocks of a BaseModule, Sequential or Group."""
+    if isinstance(module, BaseModule):
+        io_ids = {x._id for x in module.architecture.inputs+module.architecture.outputs}
+        children = [(b, id_strip_parent_prefix(k)) for k, b in module.blocks.items() if k not in io_ids]
+    elif isinstance(module, Group):
+        children = [(b, id_strip_parent_prefix(k)) for k, b in module.blocks.items()]
+    elif isinstance(module, Sequential):
+        children = [(b, str(n)) for n, b in enumerate(module.blocks)]
+    else:
+        return
+    for block_cfg, name in children:
+        submodule = getattr(module, name)
+        yield NestedBlock(block_cfg, submodule, module, name)
+        yield from named_blocks(submodule)
+
+
+def block_forward(module, *args, **kwargs):
+    """Calls a block, using gradient checkpointing if enabled for it and gradient is being computed."""
+    if getattr(module, 'checkpointed', False) and torch.is_grad_enabled():
+        return torch.utils.checkpoint.checkpoint(module, *args, use_reentrant=False, **kwargs)
+    return module(*args, **kwargs)
+
+
+_branch_executors = weakref.WeakKeyDictionary()
+_branch_worker = threading.local()
+
+
+def get_branch_executor(module: torch.nn.Module) -> ThreadPoolExecutor:
+    """Returns the thread pool of a module for running graph branches concurrently, released together with the module."""
+    executor = _branch_executors.get(module)
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=module.branch_threads, thread_name_prefix='narchi_branch')
+        _branch_executors[module] = executor
+    return executor
+
+
+def storage_ptr(value) -> int:
+    """Returns the pointer of the storage of a tensor, None if not a tensor or on the meta device."""
+    if not isinstance(value, torch.Tensor) or value.is_meta:
+        return None
+    return value.untyped_storage().data_ptr()
+
+
+def inplace_forward(submodule, inputs, overwrite):
+    """Runs an element-wise block in place if supported.
+
+    Args:
+        submodule: The block to run.
+        inputs: The list of input tensors.
+        overwrite: For each input whether it can be overwritten.
+
+    Returns:
+        The result or None if the block can't be run in place.
+    """
+    if not all(isinstance(x, torch.Tensor) for x in inputs) or submodule._forward_pre_hooks or submodule._forward_hooks:
+        return None
+    if torch.is_grad_enabled():
+        return None  # autograd may have saved the input for the backward of another consumer
+    if isinstance(submodule, Add):
+        shape = torch.broadcast_shapes(*[x.shape for x in inputs])
+        dtype = reduce(torch.promote_types, [x.dtype for x in inputs])
+        idx = next((n for n, x in enumerate(inputs) if overwrite[n] and x.shape == shape and x.dtype == dtype), None)
+        if idx is None:
+            return None
+        result = inputs[idx]
+        for num, value in enumerate(inputs):
+            if num != idx:
+                result.add_(value)
+        return result
+    if len(inputs) != 1 or not overwrite[0]:
+        return None
+    if isinstance(submodule, torch.nn.Dropout) and not submodule.training:
+        return inputs[0]
+    if isinstance(submodule, torch.nn.ReLU):
+        return torch.relu_(inputs[0])
+    if isinstance(submodule, torch.nn.LeakyReLU):
+        return torch.nn.functional.leaky_relu_(inputs[0], submodule.negative_slope)
+    if isinstance(submodule, torch.nn.Sigmoid):
+        return torch.sigmoid_(inputs[0])
+    if isinstance(submodule, torch.nn.Tanh):
+        return torch.tanh_(inputs[0])
+    return None
+
+
+def node_forward(module, node, inputs, values, overwrite=None):
+    """Runs the forward of a single graph node given the dictionary of available values.
+
+    Args:
+        module: The module that has the node as attribute.
+        node: ID of the node to run.
+        inputs: IDs of the inputs of the node.
+        values: Dictionary of available values.
+        overwrite: For each input whether it can be overwritten, i.e. run in place.
+    """
+    submodule = getattr(module, id_strip_parent_prefix(node))
+    try:
+        if overwrite and any(overwrite):
+            result = inplace_forward(submodule, [values[x] for x in inputs], overwrite)
+            if result is not None:
+                return result
+        if isinstance(submodule, BaseModule):
+            assert len(inputs) == 1
+            assert len(submodule.architecture.inputs) == 1
+            return block_forward(submodule, **{submodule.architecture.inputs[0]._id: values[inputs[0]]})
+        else:
+            return block_forward(submodule, *[values[x] for x in inputs])
+    except Exception as ex:
+        raise type(ex)(f'{type(submodule).__name__}[id={node}]: {ex}') from ex
+
+
+def get_autocast_modes() -> List[Tuple[str, torch.dtype]]:
+    """Returns the device types and dtypes of the autocast regions enabled in the current thread."""
+    if hasattr(torch, 'get_autocast_dtype'):
+        return [(d, torch.get_autocast_dtype(d)) for d in ['cpu', 'cuda'] if torch.is_autocast_enabled(d)]
+    modes = []
+    if torch.is_autocast_cpu_enabled():
+        modes.append(('cpu', torch.get_autocast_cpu_dtype()))
+    if torch.is_autocast_enabled():
+        modes.append(('cuda', torch.get_autocast_gpu_dtype()))
+    return modes
+
+
+def branch_node_forward(grad_enabled, inference_mode, autocast_modes, *args):
+    """Runs node_forward in a worker thread with the grad and autocast modes of the calling thread."""
+    _branch_worker.active = True
+    try:
+        with ExitStack() as stack:
+            stack.enter_context(torch.inference_mode(inference_mode))
+            stack.enter_context(torch.set_grad_enabled(grad_enabled))
+            for device_type, dtype in autocast_modes:
+                stack.enter_context(torch.autocast(device_type, dtype=dtype))
+            return node_forward(*args)
+    finally:
+        _branch_worker.active = False
 
-        if intermediate_outputs:
-            module.intermediate_outputs[node] = result
 
-        for input in inputs:
-            if needed_until[input] == node:
-                del values[input]
+def graph_forward(module, values, out_ids=set(), intermediate_outputs=False):
+    """Runs a forward for a module using its graph topological_predecessors."""
+
+    if intermediate_outputs and not hasattr(module, 'intermediate_outputs'):
+        module.intermediate_outputs = OrderedDict()
+
+    topological_predecessors = module.topological_predecessors
+    needed_until = get_needed_until(topological_predecessors)
+
+    branch_threads = getattr(module, 'branch_threads', 1)
+    sequential = getattr(_branch_worker, 'active', False) or (module.training and getattr(module, 'has_shared_blocks', False))
+    if branch_threads > 1 and not sequential:
+        executor = get_branch_executor(module)
+        thread_modes = (torch.is_grad_enabled(), torch.is_inference_mode_enabled(), get_autocast_modes())
+        levels = get_level_sets({k: v for k, v in topological_predecessors.items() if k not in out_ids})
+        levels.append([x for x in topological_predecessors.keys() if x in out_ids])
+    else:
+        levels = [[x] for x in topological_predecessors.keys()]
+
+    inplace = getattr(module, 'inplace', False) and not intermediate_outputs
+    if inplace:
+        protected_ids = set(values.keys()) | {v[0] for k, v in topological_predecessors.items() if k in out_ids}
+        protected_ptrs = {storage_ptr(v) for v in values.values()}
+
+    def can_overwrite(node, input):
+        if input in protected_ids or needed_until[input] != node or topological_predecessors[node].count(input) > 1:
+            return False
+        ptr = storage_ptr(values[input])
+        return ptr is not None and ptr not in protected_ptrs and not any(storage_ptr(v) == ptr for k, v in values.items() if k != input)
+
+    for level in levels:
+        if len(level) > 1:
+            futures = [executor.submit(branch_node_forward, *thread_modes, module, node, topological_predecessors[node], values)
+                       for node in level if node not in out_ids]
+            results = [f.result() for f in futures]
+        else:
+            results = []
+            for node in level:
+                if node not in out_ids:
+                    inputs = topological_predecessors[node]
+                    overwrite = [can_overwrite(node, x) for x in inputs] if inplace else None
+                    results.append(node_forward(module, node, inputs, values, overwrite))
+
+        for node in level:
+            inputs = topological_predecessors[node]
+            if node in out_ids:
+                values[node] = values[inputs[0]]
+                continue
+            result = results.pop(0)
+            #from torchvision.utils import save_image
+            #torch.save(result, f'/tmp/new_{node}.pth')
+            values[node] = result
+
+            if intermediate_outputs:
+                module.intermediate_outputs[node] = result
+
+        for node in level:
+            if node in out_ids:
+                continue
+            for input in topological_predecessors[node]:
+                if needed_until[input] == node:
+                    del values[input]
 
 
 standard_pytorch_blocks_mappings = {
@@ -344,6 +1432,12 @@ standard_pytorch_blocks_mappings = {
     'LeakyReLU': {
         'class': 'torch.nn.LeakyReLU',
     },
+    'Sigmoid': {
+        'class': 'torch.nn.Sigmoid',
+    },
+    'Tanh': {
+        'class': 'torch.nn.Tanh',
+    },
     'Dropout': {
         'class': 'torch.nn.Dropout',
     },
@@ -376,6 +1470,9 @@ standard_pytorch_blocks_mappings = {
         #    'ceil_mode': 'const:bool:True',
         #},
     },
+    'AvgPool2d': {
+        'class': 'torch.nn.AvgPool2d',
+    },
     'AdaptiveAvgPool1d': {
         'class': 'torch.nn.AdaptiveAvgPool1d',
         'kwargs': {
@@ -1,23 +1,94 @@
 """A pytorch module instantiator that supports 1d and 2d packed sequences."""
 
-import math
 import torch
+import torch.utils.data
 import numpy as np
 from copy import deepcopy
+from functools import lru_cache, partial
 from collections import namedtuple
-from torch.nn.utils.rnn import PackedSequence
-from typing import List, Tuple, Union
+from concurrent.futures import Executor, ProcessPoolExecutor
+from multiprocessing import get_context
+from torch.nn.utils.rnn import PackedSequence, pack_sequence, pad_packed_sequence
+from torch.utils.data import default_collate
+from typing import Iterator, List, Tuple, Union
 
 from .pytorch import BaseModule, Reshape, standard_pytorch_blocks_mappings
 
 
-class Packed2dSequence(namedtuple('Packed2dSequence', 'data lengths gaps')):
-    """Named tuple for packed 2d sequences."""
+class Packed2dSequence(namedtuple('Packed2dSequence', 'data lengths gaps gaps_index rows sorted_indices', defaults=(None, None, None))):
+    """Named tuple for packed 2d sequences.
+
+    The optional gaps_index is a cached tensor with the positions along the
+    packed length of the gaps, see :func:`packed_2d_gaps_index`. If rows is not
+    None, the data is a multi-row canvas [R, C, H, W] and rows has the row index
+    of each sample, the samples in each row followed by gaps that fill the width.
+    Positions are then along the R*W length of the rows one after the other.
+    If the input samples were sorted by length, sorted_indices has the input
+    index of each packed sample, and it is kept in the PackedSequence.
+    """
+
+    @property
+    def shape(self) -> torch.Size:
+        """The shape of `self.data`."""
+        return self.data.shape
+
 
     def to(self, *args, **kwargs):
         """Performs dtype and/or device conversion on `self.data`."""
         data = self.data.to(*args, **kwargs)
-        return type(self)(data=data, lengths=self.lengths, gaps=self.gaps)
+        gaps_index = None if self.gaps_index is None else self.gaps_index.to(device=data.device)
+        return self._replace(data=data, gaps_index=gaps_index)
+
+
+def packed_2d_offsets(lengths: np.ndarray, gaps: np.ndarray, rows: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Gets the start positions of the samples along the packed length and the sample order along it."""
+    order = np.arange(len(lengths)) if rows is None else np.argsort(rows, kind='stable')
+    sizes = (lengths+gaps)[order]
+    offsets = np.empty(len(lengths), dtype=int)
+    offsets[order] = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    return offsets, order
+
+
+def packed_2d_row_ends(lengths: np.ndarray, rows: np.ndarray = None) -> np.ndarray:
+    """Gets a boolean array that is True for the samples that are the last in their row."""
+    row_ends = np.zeros(len(lengths), dtype=bool)
+    if rows is None:
+        row_ends[-1] = True
+    else:
+        row_ends[len(rows)-1-np.unique(rows[::-1], return_index=True)[1]] = True
+    return row_ends
+
+
+def packed_2d_gaps_index(lengths: np.ndarray, gaps: np.ndarray, rows: np.ndarray = None, device: torch.device = None) -> torch.Tensor:
+    """Creates a tensor with the positions along the packed length of all the gaps."""
+    _, order = packed_2d_offsets(lengths, gaps, rows)
+    sizes = np.stack([lengths[order], gaps[order]], axis=1).reshape(-1)
+    is_gap = np.repeat(np.tile([False, True], len(lengths)), sizes)
+    return torch.from_numpy(np.flatnonzero(is_gap)).to(device=device)
+
+
+def pack_rows(sizes: np.ndarray, min_sizes: np.ndarray, width: int) -> np.ndarray:
+    """Assigns samples to rows of a given width following the first-fit decreasing bin packing.
+
+    Args:
+        sizes: Size of each sample including its gap, in decreasing order.
+        min_sizes: Size of each sample if it is the last in a row.
+        width: The width of the rows.
+
+    Returns:
+        The row index of each sample.
+    """
+    rows = np.zeros(len(sizes), dtype=int)
+    used = np.zeros(0, dtype=int)
+    for num, (size, min_size) in enumerate(zip(sizes, min_sizes)):
+        fits = np.flatnonzero(used + min_size <= width)
+        if len(fits) > 0:
+            rows[num] = fits[0]
+            used[fits[0]] += size
+        else:
+            rows[num] = len(used)
+            used = np.append(used, size)
+    return rows
 
 
 def pack_2d_sequences(
@@ -25,6 +96,8 @@ def pack_2d_sequences(
     gap_size: int = 0,
     length_fact: int = 1,
     fail_if_unsorted: bool = True,
+    row_width: int = None,
+    shared_memory: bool = False,
 ) -> Packed2dSequence:
     """Packs 3-dim tensors into a long 3-dim tensor by concatenating along the last dimension.
 
@@ -32,10 +105,14 @@ def pack_2d_sequences(
         input: Input tensors to pack with shapes [C, H, Wi].
         gap_size: Size for gap between samples.
         length_fact: Increase gaps so that length of inputs are multiple of length_fact.
-        fail_if_unsorted: Whether to raise ValueError if received unsorted input.
+        fail_if_unsorted: Whether to raise ValueError if received unsorted input, if not the permutation is kept in sorted_indices.
+        row_width: If given, samples are packed into a multi-row canvas of this width (rounded up to a multiple
+            of length_fact, and increased to the longest sample if wider).
+        shared_memory: Whether to allocate the packed tensor in shared memory, e.g. in DataLoader workers.
+            Ignored if an input requires grad.
 
     Returns:
-        Packed2dSequence(data=tensor[1, C, H, lengths+gaps], lenghts=list[len(input)], gaps=[len(input)])
+        Packed2dSequence(data=tensor[R, C, H, W], lenghts=list[len(input)], gaps=[len(input)], gaps_index=tensor[gaps], rows=list[len(input)])
     """
     if not (isinstance(input, (tuple, list))
             and all([hasattr(x, 'shape') for x in input])
@@ -47,47 +124,90 @@ def pack_2d_sequences(
 
     ## Check that input is sorted from longest to shortest ##
     lengths = np.array([x.shape[2] for x in input], dtype=int)
-    if any([d > 0 for d in np.diff(lengths)]):
+    sorted_indices = None
+    if any(np.diff(lengths) > 0):
         if fail_if_unsorted:
             raise ValueError('Expected input to be sorted from longest to shortest.')
-        input = list(input)
-        input.sort(key=lambda x: x.shape[2], reverse=True)
-        lengths = np.array([x.shape[2] for x in input], dtype=int)
-
-    ## Determine gaps ##
-    gaps = np.zeros(len(input), dtype=int)
-    for num in range(len(input)):
-        gaps[num] = gap_size if num < len(input)-1 else 0
-        fact_off = (lengths[num]+gaps[num]) % length_fact
-        if fact_off > 0:
-            gaps[num] += length_fact - fact_off
-
-    ## Create tensor for packing ##
-    total_length = lengths.sum() + gaps.sum()
-    packed = torch.zeros((1, *input[0].shape[0:2], total_length), dtype=input[0].dtype, device=input[0].device)  # pylint: disable=no-member
-
-    ## Copy input to packed tensor ##
-    offset = 0
-    for num in range(len(input)):
-        packed[0, :, :, offset:offset+lengths[num]] = input[num]
-        offset += lengths[num] + gaps[num]
-
-    return Packed2dSequence(data=packed, lengths=lengths, gaps=gaps)
+        sorted_indices = np.argsort(-lengths, kind='stable')
+        input = [input[num] for num in sorted_indices]
+        lengths = lengths[sorted_indices]
+
+    ## Determine rows and gaps ##
+    gaps = np.full(len(input), gap_size, dtype=int)
+    rows = None
+    if row_width is None:
+        gaps[-1] = 0
+        gaps += -(lengths+gaps) % length_fact
+    else:
+        gaps += -(lengths+gaps) % length_fact
+        min_sizes = lengths + (-lengths % length_fact)
+        width = max(row_width + (-row_width % length_fact), min_sizes[0])
+        rows = pack_rows(lengths+gaps, min_sizes, width)
+        row_ends = packed_2d_row_ends(lengths, rows)
+        row_totals = np.bincount(rows, weights=lengths+gaps).astype(int)
+        gaps[row_ends] += width - row_totals[rows[row_ends]]
+
+    ## Copy input and zero gaps to packed tensor with a concatenation per row ##
+    num_rows = 1 if rows is None else rows.max()+1
+    zeros = input[0].new_zeros((*input[0].shape[0:2], gaps.max()))
+    rows_parts = []
+    for row in range(num_rows):
+        samples = range(len(input)) if rows is None else np.flatnonzero(rows == row)
+        rows_parts.append([p for num in samples for p in (input[num], zeros[:, :, :gaps[num]]) if p.shape[2] > 0])
+    if shared_memory and not any(x.requires_grad for x in input):
+        ## Concatenate directly into shared memory, out= does not support autograd ##
+        shape = (num_rows, *input[0].shape[0:2], (lengths.sum()+gaps.sum())//num_rows)
+        storage = input[0]._typed_storage()._new_shared(int(np.prod(shape)), device=input[0].device)
+        packed = input[0].new(storage).resize_(shape)
+        for row, parts in enumerate(rows_parts):
+            torch.cat(parts, dim=2, out=packed[row])
+    elif num_rows == 1:
+        packed = torch.cat(rows_parts[0], dim=2).unsqueeze(0)
+    else:
+        packed = torch.stack([torch.cat(parts, dim=2) for parts in rows_parts])
+    if gaps.sum() == 0:
+        return Packed2dSequence(data=packed, lengths=lengths, gaps=gaps, rows=rows, sorted_indices=sorted_indices)
+    gaps_index = packed_2d_gaps_index(lengths, gaps, rows, device=packed.device)
+
+    return Packed2dSequence(data=packed, lengths=lengths, gaps=gaps, gaps_index=gaps_index, rows=rows, sorted_indices=sorted_indices)
 
 
 def packed_2d_set_gaps_to_zero(packed: Packed2dSequence) -> Packed2dSequence:
-    """Sets to zero the gap locations of a Packed2dSequence."""
+    """Sets to zero the gap locations of a Packed2dSequence, computing its gaps_index if not already cached."""
     assert isinstance(packed, Packed2dSequence), 'Expected input to be a Packed2dSequence.'
-    lengths = packed.lengths
-    gaps = packed.gaps
-    if len(lengths) > 1 and gaps.sum() > 0:
-        offset = 0
-        for num in range(len(lengths)):
-            packed.data[0, :, :, offset+lengths[num]:offset+lengths[num]+gaps[num]] = 0.0
-            offset += lengths[num] + gaps[num]
+    if (len(packed.lengths) > 1 or packed.rows is not None) and packed.gaps.sum() > 0:
+        if packed.gaps_index is None:
+            gaps_index = packed_2d_gaps_index(packed.lengths, packed.gaps, packed.rows, device=packed.data.device)
+            packed = packed._replace(gaps_index=gaps_index)
+        if packed.data.shape[0] == 1:
+            packed.data.index_fill_(3, packed.gaps_index, 0.0)
+        else:
+            width = packed.data.shape[3]
+            packed.data[packed.gaps_index // width, :, :, packed.gaps_index % width] = 0.0
     return packed
 
 
+@lru_cache(maxsize=32)
+def packed_2d_to_1d_index(
+    lengths: Tuple[int],
+    gaps: Tuple[int],
+    rows: Tuple[int],
+    device: torch.device,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Gets the positions along a packed 2d sequence of the time-major frames of a PackedSequence, and its batch_sizes.
+
+    Results are cached per lengths, gaps, rows and device signature.
+    """
+    lengths = np.array(lengths, dtype=int)
+    rows = None if rows is None else np.array(rows, dtype=int)
+    offsets, _ = packed_2d_offsets(lengths, np.array(gaps, dtype=int), rows)
+    steps = np.arange(lengths[0])[:, None]
+    valid = steps < lengths[None, :]
+    index = (offsets[None, :] + steps)[valid]
+    batch_sizes = torch.from_numpy(valid.sum(axis=1))
+    return torch.from_numpy(index).to(device=device), batch_sizes
+
+
 def packed_2d_to_1d(packed_2d: Packed2dSequence) -> PackedSequence:
     """Converts a Packed2dSequence to a PackedSequence."""
     assert isinstance(packed_2d, Packed2dSequence), 'Expected input to be a Packed2dSequence.'
@@ -95,31 +215,158 @@ def packed_2d_to_1d(packed_2d: Packed2dSequence) -> PackedSequence:
     data = packed_2d.data
     lengths = packed_2d.lengths
     gaps = packed_2d.gaps
+    rows = None if packed_2d.rows is None else tuple(packed_2d.rows.tolist())
+    index, batch_sizes = packed_2d_to_1d_index(tuple(lengths.tolist()), tuple(gaps.tolist()), rows, data.device)
 
-    ## Reserve memory for packed 1d tensor ##
-    packed_1d_length = lengths.sum()
-    packed_1d_size = (packed_1d_length, np.prod(data.shape[1:3]))
-    data_1d = torch.zeros(packed_1d_size, dtype=data.dtype, device=data.device)  # pylint: disable=no-member
-
-    ## Get packed 2d sequence offsets and batch_sizes ##
-    offsets = [0]
-    batch_sizes = torch.zeros(lengths[0], dtype=torch.long)  # pylint: disable=no-member
-    for num, length in enumerate(lengths):
-        offsets.append(offsets[num]+length+gaps[num])
-        batch_sizes[0:length] += 1
-
-    ## Copy data to packed 1d tensor ##
-    t = 0
-    p = 0
-    for nsamp in batch_sizes:
-        for num in range(nsamp):
-            data_1d[p, :] = data[0, :, :, offsets[num]+t].reshape(-1)
-            p += 1
-        t += 1
+    ## Gather frames from a transposed [length, C*H] view, or from [R, C*H, W] for a multi-row canvas ##
+    if data.shape[0] == 1:
+        data_1d = data[0].reshape(-1, data.shape[3]).t().index_select(0, index)
+    else:
+        width = data.shape[3]
+        data_1d = data.reshape(data.shape[0], -1, width)[index // width, :, index % width]
 
     ## Return PackedSequence ##
-    sorted_indices = torch.tensor([num for num in range(len(lengths))], dtype=torch.long, device=data.device)  # pylint: disable=not-callable,no-member
-    return PackedSequence(data_1d, batch_sizes, sorted_indices, sorted_indices)
+    if packed_2d.sorted_indices is None:
+        sorted_indices = torch.arange(len(lengths), dtype=torch.long, device=data.device)  # pylint: disable=no-member
+        return PackedSequence(data_1d, batch_sizes, sorted_indices, sorted_indices)
+    sorted_indices = torch.from_numpy(packed_2d.sorted_indices).to(device=data.device)
+    return PackedSequence(data_1d, batch_sizes, sorted_indices)
+
+
+def packed_sample_major_index(packed: PackedSequence) -> Tuple[np.ndarray, np.ndarray]:
+    """Gets the positions of the frames of a PackedSequence ordered by sample in original order, and the sample lengths."""
+    batch_sizes = packed.batch_sizes.numpy()
+    steps = np.arange(len(batch_sizes))
+    lengths = (batch_sizes[None, :] > np.arange(batch_sizes[0])[:, None]).sum(axis=1)
+    samples = np.arange(batch_sizes[0]) if packed.unsorted_indices is None else packed.unsorted_indices.cpu().numpy()
+    time_offsets = np.concatenate([[0], np.cumsum(batch_sizes)[:-1]])
+    positions = time_offsets[None, :] + samples[:, None]
+    return positions[steps[None, :] < lengths[samples][:, None]], lengths[samples]
+
+
+def unpack_sequences(packed: PackedSequence, padded: bool = False) -> Union[List[torch.Tensor], Tuple[torch.Tensor, torch.Tensor]]:
+    """Unpacks a PackedSequence into per-sample tensors in the original order, i.e. before sorting by length.
+
+    Args:
+        packed: The packed sequence, e.g. the output of a :class:`PackedModule`.
+        padded: Whether to return a padded tensor instead of a list.
+
+    Returns:
+        If padded, a tuple with a tensor [batch, max_length, ...] and the lengths, otherwise a list of tensors [length, ...].
+    """
+    if padded:
+        return pad_packed_sequence(packed, batch_first=True)
+
+    ## Reorder frames from time-major to sample-major with one gather, then split ##
+    index, lengths = packed_sample_major_index(packed)
+    data = packed.data.index_select(0, torch.from_numpy(index).to(device=packed.data.device))
+    return list(data.split(lengths.tolist()))
+
+
+def ctc_greedy_decode(packed: PackedSequence, blank: int = 0) -> List[List[int]]:
+    """Decodes a PackedSequence of CTC scores by best path, vectorized over all frames of all samples.
+
+    Args:
+        packed: Packed scores [frames, symbols], e.g. the log-probabilities output of a :class:`PackedModule`.
+        blank: Index of the CTC blank symbol.
+
+    Returns:
+        The decoded symbols for each sample in the original order.
+    """
+    best = packed.data.argmax(dim=-1).cpu().numpy()
+
+    ## The previous frame of the same sample is batch_sizes[t-1] positions before ##
+    batch_sizes = packed.batch_sizes.numpy()
+    steps = np.repeat(np.arange(len(batch_sizes)), batch_sizes)
+    previous = np.arange(len(best)) - np.concatenate([[0], batch_sizes[:-1]])[steps]
+    keep = (best != blank) & ((steps == 0) | (best != best[previous]))
+
+    ## Select kept symbols in sample-major order and split by sample ##
+    index, lengths = packed_sample_major_index(packed)
+    sample = np.repeat(np.arange(len(lengths)), lengths)
+    keep = keep[index]
+    counts = np.bincount(sample[keep], minlength=len(lengths))
+    return [x.tolist() for x in np.split(best[index][keep], np.cumsum(counts)[:-1])]
+
+
+def ctc_prefix_beam_search(log_probs: np.ndarray, beam_size: int = 10, blank: int = 0) -> List[int]:
+    """CTC prefix beam search for a single sample.
+
+    At each frame only the beam_size most probable symbols, plus the blank, are
+    considered for extending the prefixes.
+
+    Args:
+        log_probs: Log-probabilities [length, symbols].
+        beam_size: Number of prefixes kept after each frame.
+        blank: Index of the CTC blank symbol.
+
+    Returns:
+        The most probable symbol sequence.
+    """
+    beams = {(): (0.0, -np.inf)}  # prefix: (log prob ending in blank, log prob ending in non-blank)
+    num_candidates = min(beam_size, log_probs.shape[1])
+    for frame in log_probs:
+        candidates = np.argpartition(-frame, num_candidates-1)[:num_candidates]
+        extended = {}
+
+        def add(prefix, p_b=-np.inf, p_nb=-np.inf):
+            prev_b, prev_nb = extended.get(prefix, (-np.inf, -np.inf))
+            extended[prefix] = (np.logaddexp(prev_b, p_b), np.logaddexp(prev_nb, p_nb))
+
+        for prefix, (p_b, p_nb) in beams.items():
+            p_total = np.logaddexp(p_b, p_nb)
+            add(prefix, p_b=p_total+frame[blank])
+            for symbol in candidates:
+                if symbol == blank:
+                    continue
+                lp = frame[symbol]
+                if prefix and prefix[-1] == symbol:
+                    add(prefix, p_nb=p_nb+lp)
+                    add(prefix+(symbol,), p_nb=p_b+lp)
+                else:
+                    add(prefix+(symbol,), p_nb=p_total+lp)
+        beams = dict(sorted(extended.items(), key=lambda x: -np.logaddexp(*x[1]))[:beam_size])
+    return [int(x) for x in max(beams.items(), key=lambda x: np.logaddexp(*x[1]))[0]]
+
+
+def ctc_beam_decode(
+    packed: PackedSequence,
+    beam_size: int = 10,
+    blank: int = 0,
+    num_workers: int = 0,
+    executor: Executor = None,
+) -> List[List[int]]:
+    """Decodes a PackedSequence of CTC log-probabilities by prefix beam search on CPU.
+
+    With num_workers > 0 the worker processes are spawned for each call, thus
+    each of them imports torch every time, which can take longer than decoding
+    a batch. For decoding repeatedly, e.g. in a loop over batches, create a
+    process pool once and give it as executor.
+
+    Usage:
+        with ProcessPoolExecutor(max_workers=4, mp_context=get_context('spawn')) as executor:
+            for batch in loader:
+                decoded = ctc_beam_decode(module(**batch), executor=executor)
+
+    Args:
+        packed: Packed log-probabilities [frames, symbols], e.g. the output of a :class:`PackedModule` ending in LogSoftmax.
+        beam_size: Number of prefixes kept after each frame.
+        blank: Index of the CTC blank symbol.
+        num_workers: Number of processes spawned for this call in which to decode the samples in parallel, if 0 decoding is in this process.
+        executor: Executor in which to decode, e.g. a process pool reused across calls, if given num_workers is ignored.
+
+    Returns:
+        The decoded symbols for each sample in the original order.
+    """
+    samples = [x.numpy() for x in unpack_sequences(packed._replace(data=packed.data.detach().float().cpu()))]
+    decode = partial(ctc_prefix_beam_search, beam_size=beam_size, blank=blank)
+    if executor is not None:
+        return list(executor.map(decode, samples))
+    if num_workers == 0:
+        return [decode(x) for x in samples]
+    chunksize = max(1, len(samples)//(4*num_workers))
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=get_context('spawn')) as executor:
+        return list(executor.map(decode, samples, chunksize=chunksize))
 
 
 class ReshapePacked(Reshape):
@@ -127,10 +374,14 @@ class ReshapePacked(Reshape):
 
     def forward(self, input):
         """Transforms the shape of the input according to the specification in reshape_spec."""
+        if isinstance(input, PackedSequence):
+            if self.reshape_spec != [1, 0]:
+                raise RuntimeError('Reshape of PackedSequence only supported for reshape_spec=[1, 0].')
+            return input  # data is [frames, features] for both [length, features] and [features, length]
         if not isinstance(input, Packed2dSequence):
             return super().forward(input)
         if self.reshape_spec != [2, [0, 1]]:
-            raise RuntimeError(f'Reshape of Packed2dSequence only supported for reshape_spec=[2, [0, 1]].')
+            raise RuntimeError('Reshape of Packed2dSequence only supported for reshape_spec=[2, [0, 1]].')
         return packed_2d_to_1d(input)
 
 
@@ -159,12 +410,13 @@ class Conv2dPacked(torch.nn.Conv2d):
     def forward(self, input):
         if not isinstance(input, Packed2dSequence):
             return super().forward(input)
-        if any(g<self.min_gap for g in input.gaps[:-1]):
+        inner_gaps = input.gaps[~packed_2d_row_ends(input.lengths, input.rows)]
+        if (inner_gaps < self.min_gap).any():
             raise RuntimeError(f'Gaps too small to prevent interference between samples, min_gap={self.min_gap} '
-                               f'gaps={list(input.gaps[:-1])}.')
+                               f'gaps={list(inner_gaps)}.')
         output_data = super().forward(input.data)
         #_save_image_detached(output_data[0,0:3,:,:], 'post_conv.png')
-        output = packed_2d_set_gaps_to_zero(Packed2dSequence(data=output_data, lengths=input.lengths, gaps=input.gaps))
+        output = packed_2d_set_gaps_to_zero(input._replace(data=output_data))
         #_save_image_detached(output.data[0,0:3,:,:], 'post_conv_mask.png')
         return output
 
@@ -185,19 +437,13 @@ class MaxPool2dPacked(torch.nn.MaxPool2d):
             return super().forward(input)
 
         ## Compute new packed lengths and gaps ##
-        lengths = np.zeros(input.lengths.shape, dtype=int)
-        gaps = np.zeros(input.gaps.shape, dtype=int)
-        for num in range(len(lengths)):
-            length_in = input.lengths[num]
-            gap_in = input.gaps[num]
-            if (length_in+gap_in) % self.kernel_size > 0:
-                raise RuntimeError(f'Expected sum of lengths of sample and gap be a multiple of pooling kernel '
-                                   f'size: num={num} kernel_size={self.kernel_size} length={length_in} gap={gap_in}.')
-            #if self.ceil_mode:
-            lengths[num] = math.ceil(length_in/self.kernel_size)
-            #else:
-            #    lengths[num] = math.floor(length_in/self.kernel_size)
-            gaps[num] = math.floor(gap_in/self.kernel_size)
+        misaligned = np.flatnonzero((input.lengths+input.gaps) % self.kernel_size)
+        if len(misaligned) > 0:
+            num = misaligned[0]
+            raise RuntimeError(f'Expected sum of lengths of sample and gap be a multiple of pooling kernel '
+                               f'size: num={num} kernel_size={self.kernel_size} length={input.lengths[num]} gap={input.gaps[num]}.')
+        lengths = -(-input.lengths // self.kernel_size)
+        gaps = input.gaps // self.kernel_size
 
         ## Perform pooling ##
         #_save_image_detached(input.data[0,0:3,:,:], 'pre_maxpool.png')
@@ -205,10 +451,10 @@ class MaxPool2dPacked(torch.nn.MaxPool2d):
         #_save_image_detached(output_data[0,0:3,:,:], 'post_maxpool.png')
 
         ## Check that pooled tensor matches shape ##
-        if lengths.sum()+gaps.sum() != output_data.shape[-1]:
+        if lengths.sum()+gaps.sum() != output_data.shape[0]*output_data.shape[-1]:
             raise RuntimeError('Bug in implementation, pooling length differs w.r.t. lengths and gaps computation.')
 
-        return Packed2dSequence(data=output_data, lengths=lengths, gaps=gaps)
+        return input._replace(data=output_data, lengths=lengths, gaps=gaps, gaps_index=None)
 
 
 class BatchNorm2dPacked(torch.nn.BatchNorm2d):
@@ -222,7 +468,7 @@ class BatchNorm2dPacked(torch.nn.BatchNorm2d):
             return super().forward(input)
         output_data = super().forward(input.data)
         #_save_image_detached(output_data[0,0:3,:,:], 'post_bnorm.png')
-        output = packed_2d_set_gaps_to_zero(Packed2dSequence(data=output_data, lengths=input.lengths, gaps=input.gaps))
+        output = packed_2d_set_gaps_to_zero(input._replace(data=output_data))
         #_save_image_detached(output.data[0,0:3,:,:], 'post_bnorm_mask.png')
         return output
 
@@ -233,7 +479,51 @@ class LeakyReLU2dPacked(torch.nn.LeakyReLU):
         if not isinstance(input, Packed2dSequence):
             return super().forward(input)
         output_data = super().forward(input.data)
-        return Packed2dSequence(data=output_data, lengths=input.lengths, gaps=input.gaps)
+        return input._replace(data=output_data)
+
+
+class EmbeddingPacked(torch.nn.Embedding):
+    """Extension of torch.nn.Embedding that works with PackedSequence."""
+    def forward(self, input):
+        if not isinstance(input, PackedSequence):
+            return super().forward(input)
+        output_data = super().forward(input.data)
+        return input._replace(data=output_data)
+
+
+class Conv1dPacked(torch.nn.Conv1d):
+    """Extension of torch.nn.Conv1d that works with PackedSequence.
+
+    The frames of the PackedSequence are scattered into a single long sequence
+    with zero gaps of size padding between samples, convolved, and the frames
+    gathered back, thus there is no padding to the longest sample. Accepts all
+    torch.nn.Conv1d arguments, though a PackedSequence input is only supported
+    with stride 1, dilation 1 and zero padding of size kernel_size//2.
+    """
+
+    def forward(self, input):
+        if not isinstance(input, PackedSequence):
+            return super().forward(input)
+        if self.stride != (1,) or self.dilation != (1,) or self.padding != (self.kernel_size[0]//2,) or self.padding_mode != 'zeros':
+            raise NotImplementedError('PackedSequence currently only supported for stride == dilation == 1 and zero padding == kernel_size//2.')
+        batch_sizes = input.batch_sizes
+        lengths = (batch_sizes.unsqueeze(1) > torch.arange(batch_sizes[0])).sum(0).numpy()
+        gaps = np.full(len(lengths), self.padding[0], dtype=int)
+        gaps[-1] = 0
+        index, _ = packed_2d_to_1d_index(tuple(lengths.tolist()), tuple(gaps.tolist()), None, input.data.device)
+        sequence = input.data.new_zeros((int(lengths.sum()+gaps.sum()), input.data.shape[1]))
+        sequence.index_copy_(0, index, input.data)
+        output_data = super().forward(sequence.t().unsqueeze(0))[0].t().index_select(0, index)
+        return input._replace(data=output_data)
+
+
+class ReLUPacked(torch.nn.ReLU):
+    """Extension of torch.nn.ReLU that works with PackedSequence."""
+    def forward(self, input):
+        if not isinstance(input, PackedSequence):
+            return super().forward(input)
+        output_data = super().forward(input.data)
+        return input._replace(data=output_data)
 
 
 class Linear1dPacked(torch.nn.Linear):
@@ -242,7 +532,16 @@ class Linear1dPacked(torch.nn.Linear):
         if not isinstance(input, PackedSequence):
             return super().forward(input)
         output_data = super().forward(input.data)
-        return PackedSequence(data=output_data, batch_sizes=input.batch_sizes, sorted_indices=input.sorted_indices)
+        return input._replace(data=output_data)
+
+
+class DynamicLinear1dPacked(torch.ao.nn.quantized.dynamic.Linear):
+    """Extension of the dynamically quantized Linear that works with PackedSequence."""
+    def forward(self, input):
+        if not isinstance(input, PackedSequence):
+            return super().forward(input)
+        output_data = super().forward(input.data)
+        return input._replace(data=output_data)
 
 
 class LogSoftmaxPacked(torch.nn.LogSoftmax):
@@ -251,7 +550,7 @@ class LogSoftmaxPacked(torch.nn.LogSoftmax):
         if not isinstance(input, PackedSequence):
             return super().forward(input)
         output_data = super().forward(input.data)
-        return PackedSequence(data=output_data, batch_sizes=input.batch_sizes, sorted_indices=input.sorted_indices)
+        return input._replace(data=output_data)
 
 
 mappings = {
@@ -277,6 +576,22 @@ mappings = {
     'LogSoftmax': {
         'class': 'narchi.instantiators.pytorch_packed.LogSoftmaxPacked',
     },
+    'Embedding': {
+        'class': 'narchi.instantiators.pytorch_packed.EmbeddingPacked',
+        'kwargs': {
+            'embedding_dim': 'output_feats',
+        },
+    },
+    'Conv1d': {
+        'class': 'narchi.instantiators.pytorch_packed.Conv1dPacked',
+        'kwargs': {
+            'in_channels': 'shape:in:0',
+            'out_channels': 'output_feats',
+        },
+    },
+    'ReLU': {
+        'class': 'narchi.instantiators.pytorch_packed.ReLUPacked',
+    },
     'LeakyReLU': {
         'class': 'narchi.instantiators.pytorch_packed.LeakyReLU2dPacked',
         'kwargs': {
@@ -300,12 +615,14 @@ class PackedModule(BaseModule):
     """Class for instantiating pytorch modules that support 1d and 2d packed sequences."""
 
     blocks_mappings = packed_pytorch_blocks_mappings
+    dynamic_quantized_classes = dict(BaseModule.dynamic_quantized_classes, Linear='narchi.instantiators.pytorch_packed.DynamicLinear1dPacked')
 
     def __init__(
         self,
         *args,
         gap_size: int = 0,
         length_fact: int = 1,
+        row_width: int = None,
         **kwargs
     ):
         """Initializer for PackedModule class.
@@ -313,25 +630,183 @@ class PackedModule(BaseModule):
         Args:
             gap_size: Size for gap between samples.
             length_fact: Increase gaps so that length of inputs are multiple of length_fact.
+            row_width: If given, inputs are packed into a multi-row canvas of this width.
             args/kwargs: All other arguments accepted by :class:`.BaseModule`.
         """
         BaseModule.__init__(self, *args, **kwargs)
         self.gap_size = gap_size
         self.length_fact = length_fact
+        self.row_width = row_width
 
 
     def inputs_preprocess(self, values: dict):
-        """Converts tuples of tensors into Packed2dSequence.
+        """Converts tuples of 3-dim tensors into Packed2dSequence and of lower dimensional ones into PackedSequence.
 
         Args:
             values: Inputs to the module.
         """
         for key, value in values.items():
-            if isinstance(value, (tuple, list)) and not isinstance(value, Packed2dSequence):
-                values[key] = pack_2d_sequences(value, gap_size=self.gap_size, length_fact=self.length_fact)
+            if isinstance(value, (tuple, list)) and not isinstance(value, (Packed2dSequence, PackedSequence)):
+                if value[0].dim() < 3:
+                    values[key] = pack_sequence(value, enforce_sorted=False)
+                else:
+                    values[key] = pack_2d_sequences(value, gap_size=self.gap_size, length_fact=self.length_fact, row_width=self.row_width)
 
 
     def get_tensor_shape(self, value) -> List[int]:
-        if isinstance(value, Packed2dSequence):
-            return list(value.data.shape[1:])
+        if isinstance(value, PackedSequence):
+            return [len(value.batch_sizes)] + list(value.data.shape[1:])
         return super().get_tensor_shape(value)
+
+
+def packed_2d_length(lengths: np.ndarray, gap_size: int = 0, length_fact: int = 1) -> int:
+    """Computes the total length of a single-row Packed2dSequence, as created by :func:`pack_2d_sequences`."""
+    gaps = np.full(len(lengths), gap_size, dtype=int)
+    gaps[-1] = 0
+    return int((lengths + gaps + (-(lengths+gaps) % length_fact)).sum())
+
+
+class PackedBatchSampler(torch.utils.data.Sampler):
+    """Batch sampler that groups samples of similar width within a budget of pixels per packed batch.
+
+    Samples are sorted from widest to narrowest and consecutive ones are
+    grouped while the packed size, i.e. height times the length including gaps,
+    does not exceed max_pixels. Thus the indexes of each batch are sorted as
+    required by :func:`pack_2d_sequences`. A sample larger than the budget gets
+    its own batch.
+
+    Usage:
+        sampler = PackedBatchSampler(widths, max_pixels=2**20, height=64, gap_size=4, length_fact=8, shuffle=True)
+        loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=PackedCollate())
+    """
+
+    def __init__(
+        self,
+        widths: List[int],
+        max_pixels: int,
+        height: int = 1,
+        gap_size: int = 0,
+        length_fact: int = 1,
+        shuffle: bool = False,
+        seed: int = 0,
+    ):
+        """Initializer for PackedBatchSampler class.
+
+        Args:
+            widths: The width of each sample in the dataset.
+            max_pixels: Maximum height times packed length of a batch.
+            height: The height of the samples.
+            gap_size: Size for gap between samples, as given to :func:`pack_2d_sequences`.
+            length_fact: Length multiple, as given to :func:`pack_2d_sequences`.
+            shuffle: Whether to shuffle equal width samples and the order of batches on each iteration.
+            seed: Seed for shuffling, combined with the epoch, see :meth:`set_epoch`.
+        """
+        self.widths = np.array(widths, dtype=int)
+        self.max_pixels = max_pixels
+        self.height = height
+        self.gap_size = gap_size
+        self.length_fact = length_fact
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.batches = self.get_batches(np.argsort(-self.widths, kind='stable'))
+
+
+    def set_epoch(self, epoch: int):
+        """Sets the epoch used to seed the shuffling."""
+        self.epoch = epoch
+
+
+    def get_batches(self, order: np.ndarray) -> List[List[int]]:
+        """Groups sample indexes sorted by decreasing width into batches within the pixels budget."""
+        widths = self.widths[order]
+        sizes = widths + self.gap_size
+        sizes += -sizes % self.length_fact
+        last_sizes = widths + (-widths % self.length_fact)
+
+        ## Packed length from start to k is cumsum[k]-cumsum[start]+last_sizes[k], with cumsum excluding k ##
+        cumsum = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        ends = cumsum + last_sizes
+        batches = []
+        start = 0
+        while start < len(order):
+            end = int(np.searchsorted(ends, self.max_pixels//self.height + cumsum[start], side='right'))
+            end = max(end, start+1)
+            batches.append(order[start:end].tolist())
+            start = end
+        return batches
+
+
+    @property
+    def efficiency(self) -> float:
+        """The fraction of packed pixels that correspond to samples, i.e. not gaps."""
+        packed = sum(packed_2d_length(self.widths[b], self.gap_size, self.length_fact) for b in self.batches)
+        return float(self.widths.sum() / packed)
+
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = self.batches
+        if self.shuffle:
+            rng = np.random.default_rng((self.seed, self.epoch))
+            order = np.lexsort((rng.random(len(self.widths)), -self.widths))
+            batches = self.get_batches(order)
+            batches = [batches[n] for n in rng.permutation(len(batches))]
+        return iter(batches)
+
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+
+class PackedCollate:
+    """Collate function that sorts samples from widest to narrowest as required by :func:`pack_2d_sequences`.
+
+    Dataset items can be image tensors [C, H, W], or tuples whose first element
+    is the image. Images are returned as a list, or if pack is enabled as a
+    Packed2dSequence, which a :class:`PackedModule` accepts as input. The
+    other elements of the tuples are collated with the default collate in the
+    same sorted order.
+
+    When packing in DataLoader workers, the packed tensor is allocated in
+    shared memory, so packing overlaps with the forward of previous batches
+    and is not copied when sent to the main process.
+    """
+
+    def __init__(
+        self,
+        pack: bool = False,
+        gap_size: int = 0,
+        length_fact: int = 1,
+        row_width: int = None,
+    ):
+        """Initializer for PackedCollate class.
+
+        Args:
+            pack: Whether to pack the images into a Packed2dSequence.
+            gap_size: Size for gap between samples, see :func:`pack_2d_sequences`.
+            length_fact: Increase gaps so that length of inputs are multiple of length_fact.
+            row_width: If given, samples are packed into a multi-row canvas of this width.
+        """
+        self.pack = pack
+        self.gap_size = gap_size
+        self.length_fact = length_fact
+        self.row_width = row_width
+
+
+    def __call__(self, batch: list) -> Union[List[torch.Tensor], Packed2dSequence, tuple]:
+        is_tuple = isinstance(batch[0], (tuple, list))
+        images = [x[0] if is_tuple else x for x in batch]
+        order = sorted(range(len(batch)), key=lambda n: -images[n].shape[2])
+        images = [images[n] for n in order]
+        if self.pack:
+            images = pack_2d_sequences(
+                images,
+                gap_size=self.gap_size,
+                length_fact=self.length_fact,
+                row_width=self.row_width,
+                shared_memory=torch.utils.data.get_worker_info() is not None,
+            )
+        if not is_tuple:
+            return images
+        others = default_collate([tuple(batch[n][1:]) for n in order])
+        return (images, *others)
@@ -19,7 +19,7 @@ from typing import List, Optional, Union
 from .schemas import auto_tag, narchi_validator, propagated_validator
 from .graph import parse_graph
 from .sympy import sympify_variable
-from .propagators.base import BasePropagator, get_shape, create_shape, shapes_agree
+from .propagators.base import BasePropagator, get_shape, create_shape, shapes_agree, shapes_compatible
 from .propagators.group import get_blocks_dict, propagate_shapes, add_ids_prefix
 from .instantiators.common import import_object
 from . import __version__
@@ -262,6 +262,13 @@ class ModuleArchitecture:
                 raise ValueError(f'In module[id={architecture._id}] pre-output block[id={pre_output_block._id}] and output '
                                  f'shape do not agree: {pre_output_block._shape.out} vs. {output_block._shape}.')
 
+        ## Check shared blocks ##
+        try:
+            check_shared_blocks(architecture.blocks)
+        except Exception as ex:
+            self.write_json_outdir()
+            raise ex
+
         ## Update properties ##
         self.topological_predecessors = topological_predecessors
         self.cfg.propagated = True
@@ -304,6 +311,60 @@ class ModuleArchitecture:
         self.write_json(out_path)
 
 
+def get_shared_blocks(blocks: List[Namespace], shared_blocks: dict = None) -> dict:
+    """Gets, including blocks nested in Sequential and Group, the lists of blocks that have the same _id_share.
+
+    The scope of _id_share is a module, thus the blocks of nested Module
+    architectures are not included, same as in the instantiation.
+
+    Args:
+        blocks: List of blocks objects.
+        shared_blocks: Dictionary to which to add the shared blocks.
+
+    Returns:
+        Dictionary mapping each _id_share to its list of blocks.
+    """
+    if shared_blocks is None:
+        shared_blocks = {}
+    for block in blocks:
+        if hasattr(block, '_id_share'):
+            shared_blocks.setdefault(block._id_share, []).append(block)
+        if hasattr(block, 'blocks'):
+            get_shared_blocks(block.blocks, shared_blocks)
+    return shared_blocks
+
+
+def get_block_kwargs(block: Namespace) -> tuple:
+    """Gets the class and non-shape attributes of a block and its nested blocks, excluding ids and graphs."""
+    kwargs = {k: v for k, v in vars(block).items() if not k.startswith('_') and k not in {'blocks', 'graph', 'input', 'output', 'architecture'}}
+    subblocks = block.architecture.blocks if hasattr(block, 'architecture') else getattr(block, 'blocks', [])
+    return block._class, kwargs, [get_block_kwargs(b) for b in subblocks]
+
+
+def check_shared_blocks(blocks: List[Namespace]):
+    """Checks that blocks with the same _id_share have the same class and attributes and compatible shapes.
+
+    Args:
+        blocks: List of propagated blocks objects.
+
+    Raises:
+        ValueError: If shared blocks are not compatible.
+    """
+    for id_share, shared in get_shared_blocks(blocks).items():
+        first = shared[0]
+        for block in shared[1:]:
+            if block._class != first._class:
+                raise ValueError(f'Blocks with _id_share={id_share} expected to have the same class, but block[id={first._id}] '
+                                 f'is {first._class} and block[id={block._id}] is {block._class}.')
+            if get_block_kwargs(block) != get_block_kwargs(first):
+                raise ValueError(f'Blocks with _id_share={id_share} expected to have the same attributes, but block[id={first._id}] '
+                                 f'and block[id={block._id}] differ.')
+            for key in ['in', 'out']:
+                if not shapes_compatible(get_shape(key, first), get_shape(key, block)):
+                    raise ValueError(f'Blocks with _id_share={id_share} expected to have compatible {key} shapes, but block[id={first._id}] '
+                                     f'is {get_shape(key, first)} and block[id={block._id}] is {get_shape(key, block)}.')
+
+
 class ModulePropagator(BasePropagator):
     """Propagator for complete modules."""
 
@@ -333,10 +394,12 @@ class ModulePropagator(BasePropagator):
         block_ext_vars = deepcopy(ext_vars)
         if ext_vars is None:
             block_ext_vars = {}
+        elif isinstance(ext_vars, Namespace):
+            block_ext_vars = namespace_to_dict(block_ext_vars)
         elif isinstance(ext_vars, dict):
             block_ext_vars = dict(**block_ext_vars)
         if hasattr(block, '_ext_vars'):
-            block_ext_vars.update(block._ext_vars)
+            block_ext_vars.update(namespace_to_dict(block._ext_vars) if isinstance(block._ext_vars, Namespace) else block._ext_vars)
         cfg = {'ext_vars':    block_ext_vars,
                'cwd':         cwd,
                'parent_id':   block._id,
@@ -40,6 +40,13 @@ def shapes_agree(shape_from, shape_to):
     return get_shape('out', shape_from) == get_shape('in', shape_to)
 
 
+def shapes_compatible(shape1, shape2):
+    """Checks whether two shapes have the same number of dimensions and equal fixed dimensions."""
+    if len(shape1) != len(shape2):
+        return False
+    return all(not (isinstance(d1, int) and isinstance(d2, int)) or d1 == d2 for d1, d2 in zip(shape1, shape2))
+
+
 def shape_has_auto(shape):
     """Checks whether a shape has any <<auto>> values."""
     if isinstance(shape, str):
@@ -142,6 +142,7 @@ block_type = {
         '_shape':       {'$ref': '#/definitions/shape'},
         '_path':        {'$ref': '#/definitions/path'},
         '_ext_vars':    {'type': 'object'},
+        '_checkpoint':  {'type': 'boolean'},
         'blocks':       {'$ref': '#/definitions/blocks'},
         'input':        {'$ref': '#/definitions/id'},
         'output':       {'$ref': '#/definitions/id'},
@@ -300,9 +301,9 @@ mappings_schema = {
                     },
                     'additionalProperties': False,
                 },
-                'required': ['class'],
-                'additionalProperties': False,
             },
+            'required': ['class'],
+            'additionalProperties': False,
         },
     },
     'additionalProperties': False,
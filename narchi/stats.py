@@ -0,0 +1,449 @@
+"""Classes and functions for computing static statistics of architectures."""
+
+import sympy
+from collections import OrderedDict
+from jsonargparse import Namespace
+from jsonargparse.typing import NonNegativeInt, PositiveInt
+from typing import Dict, List, Optional, Tuple, Union
+from .graph import parse_graph, get_needed_until
+from .module import ModuleArchitecture
+from .propagators.base import get_shape
+from .propagators.group import get_blocks_dict
+from .schemas import id_separator
+from .sympy import sympify_variable
+
+
+stats_keys = ['params', 'macs', 'activations']
+
+
+def get_dims(shape: list, variables: dict = None) -> list:
+    """Converts a list of shape dimensions into sympy expressions.
+
+    Args:
+        shape: List of dimensions, either ints or variables.
+        variables: Values for the variables to substitute, results are rounded down.
+
+    Returns:
+        List of sympy expressions with positive symbols (None dimensions are kept).
+    """
+    dims = []
+    for dim in shape:
+        if dim is not None:
+            dim = sympify_variable(dim)
+            if variables:
+                dim = dim.subs(variables)
+                if dim.is_number:
+                    dim = sympy.floor(dim)
+            dim = dim.subs({s: sympy.Symbol(s.name, positive=True) for s in dim.free_symbols})
+        dims.append(dim)
+    return dims
+
+
+def numel(dims: list):
+    """Returns the number of elements for a list of dimensions."""
+    return sympy.Mul(*dims)
+
+
+def kernel_numel(block: Namespace, conv_dims: int):
+    """Returns the number of elements of the kernel of a convolution or pooling block."""
+    kernel = block.kernel_size
+    if isinstance(kernel, int):
+        return kernel**conv_dims
+    return numel(kernel)
+
+
+def conv_stats(block, dims_in, dims_out):
+    """Statistics for convolution blocks."""
+    groups = getattr(block, 'groups', 1)
+    weights = dims_out[0] * dims_in[0] / groups * kernel_numel(block, len(dims_in)-1)
+    params = weights + (dims_out[0] if getattr(block, 'bias', True) else 0)
+    return params, weights*numel(dims_out[1:])
+
+
+def pool_stats(block, dims_in, dims_out):
+    """Statistics for pooling blocks."""
+    return 0, numel(dims_out)*kernel_numel(block, len(dims_in)-1)
+
+
+def adaptive_pool_stats(block, dims_in, dims_out):
+    """Statistics for adaptive pooling blocks."""
+    return 0, numel(dims_in)
+
+
+def linear_stats(block, dims_in, dims_out):
+    """Statistics for linear blocks."""
+    weights = dims_in[-1] * dims_out[-1]
+    params = weights + (dims_out[-1] if getattr(block, 'bias', True) else 0)
+    return params, weights*numel(dims_out[:-1])
+
+
+def embedding_stats(block, dims_in, dims_out):
+    """Statistics for embedding blocks."""
+    return block.num_embeddings * dims_out[-1], 0
+
+
+def batchnorm_stats(block, dims_in, dims_out):
+    """Statistics for batch normalization blocks."""
+    return (2*dims_in[0] if getattr(block, 'affine', True) else 0), numel(dims_out)
+
+
+def elementwise_stats(block, dims_in, dims_out):
+    """Statistics for blocks that do one operation per output element."""
+    return 0, numel(dims_out)
+
+
+def rnn_stats(block, dims_in, dims_out):
+    """Statistics for recurrent blocks."""
+    gates = {'RNN': 1, 'GRU': 3, 'LSTM': 4}[block._class]
+    directions = 2 if getattr(block, 'bidirectional', False) else 1
+    hidden = getattr(block, 'hidden_size', block.output_feats // directions)
+    bias = getattr(block, 'bias', True)
+    params = macs = 0
+    for layer in range(getattr(block, 'num_layers', 1)):
+        input_size = dims_in[1] if layer == 0 else hidden*directions
+        weights = directions * gates * (input_size*hidden + hidden*hidden)
+        params += weights + (directions*gates*2*hidden if bias else 0)
+        macs += weights*dims_in[0]
+    return params, macs
+
+
+blocks_stats_functions = {
+    'Conv1d': conv_stats,
+    'Conv2d': conv_stats,
+    'Conv3d': conv_stats,
+    'MaxPool1d': pool_stats,
+    'MaxPool2d': pool_stats,
+    'MaxPool3d': pool_stats,
+    'AvgPool1d': pool_stats,
+    'AvgPool2d': pool_stats,
+    'AvgPool3d': pool_stats,
+    'AdaptiveAvgPool1d': adaptive_pool_stats,
+    'AdaptiveAvgPool2d': adaptive_pool_stats,
+    'AdaptiveMaxPool1d': adaptive_pool_stats,
+    'AdaptiveMaxPool2d': adaptive_pool_stats,
+    'Linear': linear_stats,
+    'Embedding': embedding_stats,
+    'BatchNorm2d': batchnorm_stats,
+    'Add': elementwise_stats,
+    'RNN': rnn_stats,
+    'GRU': rnn_stats,
+    'LSTM': rnn_stats,
+}
+"""Mapping of block classes to functions that return the (params, macs) of a block."""
+
+
+def get_subblocks(block: Namespace) -> List[Namespace]:
+    """Returns the list of nested blocks of a block, empty if it has none."""
+    if block._class == 'Module':
+        return block.architecture.blocks
+    return getattr(block, 'blocks', [])
+
+
+def blocks_stats(blocks: List[Namespace], variables: dict = None, depth: int = 1, id_shares: set = None) -> List[dict]:
+    """Computes the statistics of a list of propagated blocks and their nested blocks.
+
+    Args:
+        blocks: The propagated blocks.
+        variables: Values for the variables to substitute.
+        depth: Nesting depth of the given blocks.
+        id_shares: The _id_share values already seen in the module, for which params are not counted again.
+
+    Returns:
+        List of dicts with keys id, class, depth and the stats_keys, in depth first order. The
+        stats of blocks with nested blocks are the sum of the ones of their nested blocks.
+    """
+    if id_shares is None:
+        id_shares = set()
+    rows = []
+    for block in blocks:
+        row = {'id': block._id, 'class': block._class, 'depth': depth}
+        rows.append(row)
+        is_shared = hasattr(block, '_id_share') and block._id_share in id_shares
+        if hasattr(block, '_id_share'):
+            id_shares.add(block._id_share)
+        subblocks = get_subblocks(block)
+        if subblocks:
+            subrows = blocks_stats(subblocks, variables, depth+1, None if block._class == 'Module' else id_shares)
+            if is_shared:
+                for subrow in subrows:
+                    subrow['params'] = sympy.Integer(0)
+            for key in stats_keys:
+                row[key] = sympy.Add(*[r[key] for r in subrows if r['depth'] == depth+1])
+            rows.extend(subrows)
+            continue
+        dims_out = get_dims(get_shape('out', block), variables)
+        row['params'] = row['macs'] = sympy.Integer(0)
+        if block._class in blocks_stats_functions:
+            dims_in = get_dims(get_shape('in', block), variables)
+            params, macs = blocks_stats_functions[block._class](block, dims_in, dims_out)
+            row['params'] = sympy.Integer(0) if is_shared else sympy.sympify(params)
+            row['macs'] = sympy.sympify(macs)
+        row['activations'] = numel(dims_out)
+    return rows
+
+
+def get_block_graph(block: Namespace) -> Tuple[Dict[str, Namespace], Dict[str, List[str]], set]:
+    """Returns the blocks dict, topological_predecessors and output ids of a block with nested blocks."""
+    if block._class == 'Module':
+        architecture = block.architecture
+        topological_predecessors = parse_graph(architecture.inputs, architecture)
+        return get_blocks_dict(architecture.blocks), topological_predecessors, {x._id for x in architecture.outputs}
+    from_block = Namespace(_id=block._id+id_separator+'input')
+    return get_blocks_dict(block.blocks), parse_graph([from_block], block), set()
+
+
+def peak_step(steps: List[Tuple[sympy.Expr, List[str]]]) -> Tuple[sympy.Expr, Optional[List[str]]]:
+    """Gets the largest of a list of (size, alive_ids) steps.
+
+    Returns:
+        The size and alive ids of the largest step. If the largest can't be
+        determined due to variables, the size is a Max expression and the
+        alive ids None.
+    """
+    def heuristic(size):
+        return size.subs({s: 1000 for s in size.free_symbols})
+    sizes = [x[0] for x in steps]
+    candidate = max(range(len(steps)), key=lambda n: heuristic(sizes[n]))
+    undetermined = [x for x in set(sizes) if (sizes[candidate]-x).is_nonnegative is not True]
+    if undetermined:
+        return sympy.Max(sizes[candidate], *undetermined), None
+    return steps[candidate]
+
+
+def graph_steps(
+    blocks_dict: Dict[str, Namespace],
+    topological_predecessors: Dict[str, List[str]],
+    input_sizes: Dict[str, sympy.Expr],
+    out_ids: set,
+    variables: dict = None,
+) -> List[Tuple[sympy.Expr, List[str]]]:
+    """Simulates the liveness of a graph forward computing the activations alive at each step.
+
+    Args:
+        blocks_dict: Dictionary of the graph's propagated blocks.
+        topological_predecessors: Mapping of block IDs to its input blocks IDs.
+        input_sizes: Sizes of the inputs to consider as alive at the start.
+        out_ids: IDs of output nodes which are only references to other nodes.
+        variables: Values for the variables to substitute.
+
+    Returns:
+        List with the (size, alive_ids) for the execution of each block.
+    """
+    needed_until = get_needed_until(topological_predecessors)
+    alive = OrderedDict(input_sizes)
+    steps = []
+    for node, inputs in topological_predecessors.items():
+        if node in out_ids:
+            continue
+        block = blocks_dict[node]
+        size, block_alive = block_peak(block, variables)
+        alive_ids = None if block_alive is None else list(alive.keys()) + (block_alive or [node])
+        steps.append((sympy.Add(*alive.values()) + size, alive_ids))
+        alive[node] = numel(get_dims(get_shape('out', block), variables))
+        for input in inputs:
+            if needed_until[input] == node:
+                alive.pop(input, None)
+    return steps
+
+
+def block_peak(block: Namespace, variables: dict = None) -> Tuple[sympy.Expr, Optional[List[str]]]:
+    """Gets the peak activations during the forward of a block excluding its inputs.
+
+    Returns:
+        The peak size and the ids of nested blocks alive at the peak.
+    """
+    if not get_subblocks(block):
+        return numel(get_dims(get_shape('out', block), variables)), []
+    blocks_dict, topological_predecessors, out_ids = get_block_graph(block)
+    return peak_step(graph_steps(blocks_dict, topological_predecessors, {}, out_ids, variables))
+
+
+def stats_value(value) -> Union[int, str]:
+    """Converts a sympy expression into an int if possible, otherwise into a string."""
+    if value.is_Integer:
+        return int(value)
+    return str(value).replace(' ', '')
+
+
+class ModuleArchitectureStats(ModuleArchitecture):
+    """Class for computing parameters, operations and activation sizes of architectures without instantiating them."""
+
+    @staticmethod
+    def get_config_parser():
+        """Returns a ModuleArchitectureStats configuration parser."""
+        parser = ModuleArchitecture.get_config_parser()
+        parser.description = ModuleArchitectureStats.__doc__
+
+        # stats options #
+        group_stats = parser.add_argument_group('Statistics related options')
+        group_stats.add_argument('--variables',
+            type=dict,
+            help='Values for variable dimensions with which to evaluate the statistics.')
+        group_stats.add_argument('--nested_depth',
+            default=NonNegativeInt(1),
+            type=NonNegativeInt,
+            help='Maximum depth for nested blocks to include. Set to 0 for unlimited.')
+
+        # memory options #
+        group_memory = parser.add_argument_group('Memory related options')
+        group_memory.add_argument('--mode',
+            choices=['inference', 'training'],
+            default='inference',
+            help='Whether to plan the memory for inference or training.')
+        group_memory.add_argument('--memory_budget',
+            type=Optional[PositiveInt],
+            help='Available memory in bytes for which to compute the maximum batch size.')
+        group_memory.add_argument('--bytes_per_element',
+            default=PositiveInt(4),
+            type=PositiveInt,
+            help='Number of bytes of each element of the parameters and activations.')
+
+        return parser
+
+
+    def _get_variables(self, variables):
+        if variables is None:
+            variables = self.cfg.variables
+        if isinstance(variables, Namespace):
+            variables = vars(variables)
+        return variables
+
+
+    def stats(
+        self,
+        variables: Dict[str, int] = None,
+        nested_depth: int = None,
+    ) -> List[Dict[str, Union[str, int]]]:
+        """Computes per block number of parameters, multiply-accumulate operations and activation sizes.
+
+        All values are per batch element. The multiply-accumulates include an
+        operation per element for blocks such as pooling, additions and batch
+        normalization. The activations are the number of elements of the output
+        of each block. Blocks with nested blocks have as values the sum of the
+        ones of their nested blocks. The parameters of blocks with an _id_share
+        are only counted for the first of them within each module. For variable
+        dimensions the values are expressions.
+
+        Args:
+            variables: Values for the variable dimensions. If None uses the one from cfg.
+            nested_depth: Maximum depth of nested blocks to include. If None uses the one from cfg.
+
+        Returns:
+            List of dicts with keys id, class, depth, params, macs and activations.
+        """
+        if not self.cfg.propagated:
+            raise RuntimeError(f'{type(self).__name__} requires a propagated architecture.')
+        variables = self._get_variables(variables)
+        if nested_depth is None:
+            nested_depth = self.cfg.nested_depth
+        rows = blocks_stats(self.architecture.blocks, variables)
+        total = {'id': self.architecture._id, 'class': 'Total', 'depth': 0}
+        for key in stats_keys:
+            total[key] = sympy.Add(*[r[key] for r in rows if r['depth'] == 1])
+        rows.append(total)
+        rows = [r for r in rows if nested_depth == 0 or r['depth'] <= nested_depth]
+        for row in rows:
+            for key in stats_keys:
+                row[key] = stats_value(row[key])
+        return rows
+
+
+    def stats_table(self, variables: Dict[str, int] = None, nested_depth: int = None) -> str:
+        """Returns the statistics formatted as a table, see :meth:`stats`."""
+        rows = self.stats(variables=variables, nested_depth=nested_depth)
+        header = ['id', 'class'] + stats_keys
+        lines = [header]
+        for row in rows:
+            indent = '  '*(row['depth']-1) if row['depth'] > 0 else ''
+            lines.append([indent+row['id'], row['class']] + [str(row[k]) for k in stats_keys])
+        widths = [max(len(line[n]) for line in lines) for n in range(len(header))]
+        return '\n'.join('  '.join(v.ljust(w) for v, w in zip(line, widths)).rstrip() for line in lines)
+
+
+    def memory_plan(self, mode: str = None, variables: Dict[str, int] = None) -> Dict[str, Union[str, int, List[str]]]:
+        """Computes the peak of activations alive for a single batch element.
+
+        For inference the liveness of the graph is simulated, i.e. each
+        activation is kept until the last block that requires it. For training
+        all activations are kept for the backward, thus the peak is the sum of
+        the inputs and the outputs of all blocks. In both cases in-place
+        operations and views are not taken into account, thus the result is
+        an upper bound.
+
+        Args:
+            mode: Either "inference" or "training". If None uses the one from cfg.
+            variables: Values for the variable dimensions. If None uses the one from cfg.
+
+        Returns:
+            Dict with keys mode, params, peak (number of elements) and alive (IDs of activations
+            alive at the peak, None if it depends on the values of the variables).
+        """
+        if not self.cfg.propagated:
+            raise RuntimeError(f'{type(self).__name__} requires a propagated architecture.')
+        if mode is None:
+            mode = self.cfg.mode
+        if mode not in {'inference', 'training'}:
+            raise ValueError(f'Expected mode to be one of inference or training, got {mode}.')
+        variables = self._get_variables(variables)
+        architecture = self.architecture
+        input_sizes = OrderedDict((x._id, numel(get_dims(x._shape, variables))) for x in architecture.inputs)
+        rows = blocks_stats(architecture.blocks, variables)
+        params = sympy.Add(*[r['params'] for r in rows if r['depth'] == 1])
+        if mode == 'inference':
+            out_ids = {x._id for x in architecture.outputs}
+            blocks_dict = get_blocks_dict(architecture.blocks)
+            steps = graph_steps(blocks_dict, self.topological_predecessors, input_sizes, out_ids, variables)
+            peak, alive = peak_step(steps)
+        else:
+            peak = sympy.Add(*input_sizes.values(), *[r['activations'] for r in rows if r['depth'] == 1])
+            alive = list(input_sizes.keys()) + [b._id for b in architecture.blocks]
+        return {'mode': mode, 'params': stats_value(params), 'peak': stats_value(peak), 'alive': alive}
+
+
+    def max_batch_size(
+        self,
+        memory_budget: int = None,
+        mode: str = None,
+        bytes_per_element: int = None,
+        variables: Dict[str, int] = None,
+    ) -> Union[int, str]:
+        """Computes the largest batch size for which the parameters and activations fit in a memory budget.
+
+        For training the parameters are counted twice to account for the gradients.
+
+        Args:
+            memory_budget: Available memory in bytes. If None uses the one from cfg.
+            mode: Either "inference" or "training". If None uses the one from cfg.
+            bytes_per_element: Number of bytes of each element. If None uses the one from cfg.
+            variables: Values for the variable dimensions. If None uses the one from cfg.
+
+        Returns:
+            The maximum batch size, or an expression of it if it depends on variables.
+
+        Raises:
+            ValueError: If memory_budget is not given nor in cfg.
+        """
+        if memory_budget is None:
+            memory_budget = self.cfg.memory_budget
+        if memory_budget is None:
+            raise ValueError('A memory_budget is required to compute the maximum batch size.')
+        if bytes_per_element is None:
+            bytes_per_element = self.cfg.bytes_per_element
+        plan = self.memory_plan(mode=mode, variables=variables)
+        params = sympify_variable(plan['params']) * (2 if plan['mode'] == 'training' else 1)
+        peak = get_dims([plan['peak']])[0]
+        batch_size = sympy.floor((memory_budget - params*bytes_per_element) / (peak*bytes_per_element))
+        if batch_size.is_number:
+            return max(0, int(batch_size))
+        return stats_value(batch_size)
+
+
+    def memory_summary(self, variables: Dict[str, int] = None) -> str:
+        """Returns a summary of the memory plan and if memory_budget in cfg the maximum batch size."""
+        plan = self.memory_plan(variables=variables)
+        lines = [f'{plan["mode"]} peak activations per batch element: {plan["peak"]}']
+        if plan['alive'] is not None:
+            lines.append(f'alive at peak: {", ".join(plan["alive"])}')
+        if self.cfg.memory_budget is not None:
+            lines.append(f'max batch size: {self.max_batch_size(variables=variables)}')
+        return '\n'.join(lines)
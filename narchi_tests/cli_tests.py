@@ -9,11 +9,17 @@ import tempfile
 import unittest
 import contextlib
 from jsonargparse import dict_to_namespace
-from narchi.bin.narchi_cli import narchi_cli, get_validate_parser, get_render_parser, get_schema_parser
+from narchi.bin.narchi_cli import (narchi_cli, get_validate_parser, get_render_parser, get_stats_parser, get_profile_parser,
+                                   get_schema_parser)
 from narchi.schemas import id_separator
 from narchi.render import pygraphviz_available
 from narchi_tests.data import *
 
+try:
+    import torch
+except:
+    torch = False
+
 
 class CliTests(unittest.TestCase):
     """Tests for narchi_cli.py."""
@@ -61,6 +67,40 @@ class CliTests(unittest.TestCase):
         shutil.rmtree(tmpdir)
 
 
+    def test_stats(self):
+        args = ['stats', '--variables', '{"W": 128}', '--ext_vars', json.dumps(laia_ext_vars), laia_jsonnet]
+        with io.StringIO() as buf:
+            with contextlib.redirect_stdout(buf):
+                narchi_cli(args)
+            table = buf.getvalue()
+        self.assertIn('s3blstm', table)
+        self.assertIn('4258324', table)
+        self.assertNotIn('conv1·0  ', table)
+        self.assertIn('inference peak activations per batch element: 286720', table)
+        self.assertNotIn('max batch size', table)
+
+        args = args[:1] + ['--mode', 'training', '--memory_budget', str(2**30)] + args[1:]
+        with io.StringIO() as buf:
+            with contextlib.redirect_stdout(buf):
+                narchi_cli(args)
+            table = buf.getvalue()
+        self.assertIn('training peak activations per batch element: 672832', table)
+        self.assertIn('max batch size: 386', table)
+
+
+    @unittest.skipIf(not torch, 'torch package is required')
+    def test_profile(self):
+        args = ['profile', '--variables', '{"L": 32, "H": 32, "W": 32}', '--repetitions', '2', '--nested_depth', '1',
+                '--ext_vars', json.dumps(text_image_ext_vars), text_image_jsonnet]
+        with io.StringIO() as buf:
+            with contextlib.redirect_stdout(buf):
+                narchi_cli(args)
+            table = buf.getvalue().strip().split('\n')
+        self.assertEqual(table[0].split()[:3], ['id', 'class', 'calls'])
+        self.assertEqual({line.split()[0] for line in table[1:]}, {'text_features', 'image_features', 'add', 'fc_task1', 'fc_task2'})
+        self.assertTrue(all(line.split()[2] == '2' for line in table[1:]))
+
+
     def test_schema(self):
         with io.StringIO() as buf:
             with contextlib.redirect_stdout(buf):
@@ -80,6 +120,8 @@ class CliTests(unittest.TestCase):
     def test_get_subcommand_parsers(self):
         get_validate_parser()
         get_render_parser()
+        get_stats_parser()
+        get_profile_parser()
         get_schema_parser()
 
 
@@ -8,12 +8,18 @@ resnet_cfg = {'ext_vars': resnet_ext_vars}
 
 resnet_multiscale_jsonnet = os.path.join(data_dir, 'resnet_multiscale.jsonnet')
 
+shared_scope_jsonnet = os.path.join(data_dir, 'shared_scope.jsonnet')
+
 squeezenet_jsonnet = os.path.join(data_dir, 'squeezenet.jsonnet')
 
 text_image_jsonnet = os.path.join(data_dir, 'text_image_classification.jsonnet')
 text_image_ext_vars = {'vocabulary_size': 5000}
 text_image_cfg = {'ext_vars': text_image_ext_vars}
 
+text_tagger_jsonnet = os.path.join(data_dir, 'text_tagger.jsonnet')
+text_tagger_ext_vars = {'vocabulary_size': 100, 'num_tags': 8}
+text_tagger_cfg = {'ext_vars': text_tagger_ext_vars}
+
 laia_jsonnet = os.path.join(data_dir, 'laia.jsonnet')
 laia_ext_vars = {'num_symbols': 68}
 laia_cfg = {'ext_vars': laia_ext_vars}
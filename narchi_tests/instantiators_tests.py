@@ -3,26 +3,46 @@
 
 # pylint: disable=no-member
 
+import gc
 import os
 import shutil
 import tempfile
 import unittest
+import weakref
+from unittest import mock
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
-from narchi.instantiators.common import import_object
+from jsonargparse import dict_to_namespace
+from jsonschema.exceptions import ValidationError
+from narchi.instantiators.common import import_object, compile_mappings
 from narchi.module import ModuleArchitecture
 from narchi.schemas import auto_tag
+from narchi.stats import ModuleArchitectureStats
 from narchi_tests.data import *
 
 try:
     import torch
-    from torch.nn.utils.rnn import pad_packed_sequence
+    from torch.nn.utils.rnn import PackedSequence, pack_sequence, pad_packed_sequence
 except:
     torch = False
 
 if torch:
-    from narchi.instantiators.pytorch import BaseModule, StandardModule, Reshape, standard_pytorch_blocks_mappings
+    from narchi.instantiators.pytorch import (BaseModule, StandardModule, Reshape, Add, inplace_forward, get_branch_executor,
+                                              standard_pytorch_blocks_mappings)
     from narchi.instantiators.pytorch_packed import (PackedModule, packed_pytorch_blocks_mappings, pack_2d_sequences,
-                                                     Conv2dPacked, MaxPool2dPacked)
+                                                     packed_2d_to_1d, packed_2d_length, Conv2dPacked, MaxPool2dPacked,
+                                                     Packed2dSequence, PackedBatchSampler, PackedCollate, ReshapePacked, Conv1dPacked,
+                                                     unpack_sequences, ctc_greedy_decode, ctc_beam_decode)
+
+    class ScaledReLU(torch.nn.ReLU):
+        """ReLU with a non-persistent buffer, for testing instantiation with a state_dict."""
+        def __init__(self):
+            super().__init__()
+            self.register_buffer('scale', torch.full((1,), 2.0), persistent=False)
+
+        def forward(self, input):
+            return super().forward(input)*self.scale
 
 
 @unittest.skipIf(not torch, 'torch package is required')
@@ -136,6 +156,368 @@ class PytorchTests(unittest.TestCase):
             self.assertEqual(list(logits.shape), [1, 1000])
 
 
+    def test_shared_blocks(self):
+        module = StandardModule(resnet_multiscale_jsonnet)
+        module.eval()
+        self.assertIs(module.resnet1, module.resnet2)
+        self.assertIs(module.resnet1, module.resnet3)
+        self.assertEqual(sum(p.numel() for p in module.parameters()), sum(p.numel() for p in module.resnet1.parameters()))
+
+        state_dict = module.state_dict()
+        self.assertEqual({k.split('.')[0] for k in state_dict.keys()}, {'resnet1'})
+        module2 = StandardModule(resnet_multiscale_jsonnet, state_dict=state_dict)
+        module2.eval()
+        self.assertIs(module2.resnet2, module2.resnet3)
+        image = torch.rand(1, 3, 64, 64)
+        with torch.no_grad():
+            self.assertTrue(torch.equal(module(image=image), module2(image=image)))
+
+        stats = ModuleArchitectureStats(resnet_multiscale_jsonnet).stats()
+        self.assertEqual(stats[-1]['params'], sum(p.numel() for p in module.parameters()))
+
+
+    def test_inplace(self):
+        x = torch.rand(2, 3)
+        y = torch.rand(2, 3)
+        self.assertIsNone(inplace_forward(torch.nn.ReLU(), [x], [True]))
+        with torch.no_grad():
+            self.assertIs(inplace_forward(torch.nn.ReLU(), [x], [True]), x)
+            self.assertIsNone(inplace_forward(torch.nn.ReLU(), [x], [False]))
+            self.assertIsNone(inplace_forward(torch.nn.Conv1d(3, 3, 1), [x], [True]))
+            self.assertIs(inplace_forward(Add(), [x, y], [False, True]), y)
+            self.assertIsNone(inplace_forward(Add(), [x[:, :1], y], [True, False]))
+            self.assertIs(inplace_forward(torch.nn.Tanh(), [x.requires_grad_()], [True]), x)
+
+        for jsonnet, cfg, width in [(resnet_jsonnet, resnet_cfg, 96), (laia_jsonnet, laia_cfg, 128)]:
+            with self.subTest(jsonnet):
+                module = StandardModule(jsonnet, cfg=cfg)
+                module.eval()
+                module_inplace = StandardModule(jsonnet, cfg=cfg, inplace=True, state_dict=module.state_dict())
+                module_inplace.eval()
+                image = torch.rand(2, 3, 64, width)
+                image_orig = image.clone()
+                with torch.no_grad():
+                    logits = module(image=image)
+                    logits_inplace = module_inplace(image=image)
+                self.assertTrue(torch.allclose(logits, logits_inplace, atol=1e-5))
+                self.assertTrue(torch.equal(image, image_orig))
+                logits_inplace = module_inplace(image=image)
+                logits_inplace.sum().backward()
+                self.assertTrue(torch.allclose(logits, logits_inplace, atol=1e-5))
+
+        # Training with a value saved for the backward of another consumer #
+        architecture = {
+            '_id': 'InplaceTraining',
+            'blocks': [
+                {'_class': 'MaxPool2d', '_id': 'pool', 'kernel_size': 2, 'stride': 2},
+                {'_class': 'Conv2d', '_id': 'conv', 'output_feats': 3, 'kernel_size': 3, 'padding': 1},
+                {'_class': 'ReLU', '_id': 'relu'},
+                {'_class': 'Add', '_id': 'add'},
+            ],
+            'graph': ['image -> pool -> conv -> add', 'pool -> relu -> add -> output'],
+            'inputs': [{'_id': 'image', '_shape': [3, 16, 16]}],
+            'outputs': [{'_id': 'output', '_shape': [3, 8, 8]}],
+        }
+        module = StandardModule(dict_to_namespace(architecture))
+        module_inplace = StandardModule(dict_to_namespace(architecture), inplace=True, state_dict=module.state_dict())
+        image = torch.rand(2, 3, 16, 16)
+        module(image=image).sum().backward()
+        module_inplace(image=image).sum().backward()
+        self.assertTrue(torch.allclose(module.conv.weight.grad, module_inplace.conv.weight.grad))
+
+
+    def test_fuse_for_inference(self):
+        for jsonnet, cfg, num_bn in [(resnet_jsonnet, resnet_cfg, 20), (laia_jsonnet, laia_cfg, 4)]:
+            with self.subTest(jsonnet):
+                module = StandardModule(jsonnet, cfg=cfg)
+                self.assertRaises(RuntimeError, lambda: module.fuse_for_inference())
+                module.eval()
+                for block in module.modules():
+                    if isinstance(block, torch.nn.BatchNorm2d):
+                        block.running_mean.uniform_(-1, 1)
+                        block.running_var.uniform_(0.5, 2)
+                image = torch.rand(2, 3, 64, 96)
+                with torch.no_grad():
+                    logits = module(image=image)
+                    self.assertEqual(module.fuse_for_inference(), num_bn)
+                    self.assertFalse(any(isinstance(m, torch.nn.BatchNorm2d) for m in module.modules()))
+                    self.assertTrue(torch.allclose(logits, module(image=image), atol=1e-5))
+                    self.assertEqual(module.fuse_for_inference(), 0)
+
+
+    def test_quantize(self):
+        module = StandardModule(laia_jsonnet, cfg=laia_cfg)
+        self.assertRaises(RuntimeError, lambda: module.quantize())
+        module.eval()
+        image = torch.rand(2, 3, 64, 128)
+        with torch.no_grad():
+            logits = module(image=image)
+            self.assertEqual(module.quantize(), 2)
+            self.assertIsInstance(module.fc, torch.ao.nn.quantized.dynamic.Linear)
+            self.assertFalse(module.s3blstm.output_state)
+            logits_quantized = module(image=image)
+        self.assertEqual(logits.shape, logits_quantized.shape)
+        self.assertLess((logits-logits_quantized).abs().max(), 0.05*logits.abs().max())
+
+        module = StandardModule(text_image_jsonnet, cfg=text_image_cfg)
+        module.eval()
+        self.assertRaises(ValueError, lambda: module.quantize(include=['missing']))
+        self.assertRaises(NotImplementedError, lambda: module.quantize(include=['Conv1d']))
+        self.assertEqual(module.quantize(include=['Linear'], exclude=['fc_task2'], dtype=torch.float16), 3)
+        self.assertIsInstance(module.fc_task2, torch.nn.Linear)
+        with torch.no_grad():
+            logits = module(text=torch.randint(0, 100, (1, 64)), image=torch.rand(1, 3, 64, 64))
+        self.assertEqual([list(p.shape) for p in logits], [[1, 16], [1, 3]])
+
+
+    def test_memory_format(self):
+        module = StandardModule(laia_jsonnet, cfg=laia_cfg)
+        module.eval()
+        module_cl = StandardModule(laia_jsonnet, cfg=laia_cfg, memory_format='channels_last', state_dict=module.state_dict())
+        module_cl.eval()
+        self.assertTrue(module_cl.conv1[0].weight.is_contiguous(memory_format=torch.channels_last))
+        contiguous = []
+        module_cl.to_1d.register_forward_pre_hook(lambda m, i: contiguous.append(i[0].is_contiguous()))
+        image = torch.rand(2, 3, 64, 128)
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(module(image=image), module_cl(image=image), atol=1e-5))
+        self.assertEqual(contiguous, [True])
+
+        module_cl.set_memory_format(None)
+        self.assertEqual(module_cl.memory_format_hooks, [])
+        self.assertTrue(module_cl.conv1[0].weight.is_contiguous())
+        self.assertRaises(ValueError, lambda: module_cl.set_memory_format('channels_first'))
+
+        module_cl = StandardModule(laia_jsonnet, cfg=laia_cfg, memory_format='channels_last', meta=True)
+        module_cl.materialize()
+        self.assertTrue(module_cl.conv1[0].weight.is_contiguous(memory_format=torch.channels_last))
+
+
+    def test_capture(self):
+        tmpdir = tempfile.mkdtemp(prefix='_narchi_test_')
+        module = StandardModule(laia_jsonnet, cfg=laia_cfg, debug=True)
+        module.eval()
+        image = torch.rand(2, 3, 64, 128)
+        self.assertRaises(ValueError, lambda: module.capture(['conv9']))
+
+        for sink in ['memory', 'cpu', tmpdir]:
+            with self.subTest(sink):
+                with torch.no_grad(), module.capture(['conv?', 'conv1·1', 's3blstm'], sink=sink) as capture:
+                    module(image=image)
+                    module(image=image)
+                self.assertEqual(list(capture.outputs.keys()), ['conv1', 'conv1·1', 'conv2', 'conv3', 'conv4', 's3blstm'])
+                self.assertFalse(module.s3blstm._forward_hooks)
+                for key in ['conv4', 's3blstm']:
+                    self.assertEqual(len(capture.outputs[key]), 2)
+                    output = capture.outputs[key][1]
+                    if isinstance(output, np.ndarray):
+                        output = torch.from_numpy(np.array(output))
+                    self.assertTrue(torch.equal(output, module.intermediate_outputs[key]))
+        self.assertTrue(os.path.isfile(os.path.join(tmpdir, 'conv1·1.1.npy')))
+
+        with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16), module.capture(['conv1'], sink=tmpdir) as capture:
+            module(image=image)
+        output = capture.outputs['conv1'][0]
+        self.assertEqual(output.dtype, np.float32)
+        self.assertEqual(module.intermediate_outputs['conv1'].dtype, torch.bfloat16)
+        self.assertTrue(torch.equal(torch.from_numpy(np.array(output)), module.intermediate_outputs['conv1'].float()))
+
+        shutil.rmtree(tmpdir)
+
+
+    def test_profile(self):
+        module = StandardModule(text_image_jsonnet, cfg=text_image_cfg)
+        module.eval()
+        self.assertRaises(ValueError, lambda: module.random_inputs({'L': 32}))
+        inputs = module.random_inputs({'L': 32, 'H': 48, 'W': 64}, batch_size=2)
+        self.assertEqual(inputs['text'].dtype, torch.int64)
+        self.assertEqual(list(inputs['image'].shape), [2, 3, 48, 64])
+
+        with torch.no_grad(), torch.profiler.profile() as torch_profiler, module.profile() as profiler:
+            module(**inputs)
+        self.assertFalse(module.fc_task1._forward_hooks)
+        records = profiler.records
+        self.assertEqual(records['fc_task1']['output_shape'], [2, 16])
+        self.assertEqual(records['fc_task1']['output_bytes'], 2*16*4)
+        self.assertEqual(records['text_features·6']['class'], 'LSTM')
+        self.assertEqual(records['text_features·6']['depth'], 1)
+        self.assertTrue(all(r['calls'] == 1 for r in records.values()))
+        self.assertGreaterEqual(records['image_features']['wall_time'], records['image_features·0']['wall_time'])
+        self.assertIn('image_features·0·squeeze', {e.key for e in torch_profiler.key_averages()})
+        table = profiler.table(nested_depth=1, top=3).split('\n')
+        self.assertEqual(len(table), 4)
+        self.assertEqual(table[1].split()[0], max(['text_features', 'image_features'], key=lambda k: records[k]['wall_time']))
+
+        module = StandardModule(laia_jsonnet, cfg=laia_cfg)
+        image = torch.rand(1, 3, 64, 128)
+        with torch.no_grad(), torch.profiler.profile(profile_memory=True) as torch_profiler, module.profile() as profiler:
+            module(image=image)
+        allocated = {e.key: e.cpu_memory_usage for e in torch_profiler.key_averages()}
+        self.assertGreaterEqual(allocated['conv1'], profiler.records['conv1']['output_bytes'])
+
+        with torch.no_grad(), module.profile() as profiler, mock.patch.object(module.conv2[0], 'forward', side_effect=RuntimeError('fail')):
+            for _ in range(3):
+                self.assertRaises(RuntimeError, lambda: module(image=image))
+            self.assertEqual(profiler.running.stack, [])
+        self.assertEqual(profiler.records['conv1']['calls'], 3)
+
+
+    def test_compile_mappings(self):
+        mappings = deepcopy(standard_pytorch_blocks_mappings)
+        compiled = compile_mappings(mappings)
+        self.assertIs(compiled, compile_mappings(mappings))
+        self.assertEqual(compiled['Linear'].transforms[0], ('shape', 'in_features', 'shape:in:-1', ('in', -1)))
+        self.assertIs(compiled['Linear'].block_class, torch.nn.Linear)
+        self.assertIn('in_features', compiled['Linear'].func_param)
+
+        mappings['Linear'] = {'class': 'narchi.instantiators.pytorch_packed.Linear1dPacked', 'kwargs': {'in_features': 'shape:in:0'}}
+        compiled_changed = compile_mappings(mappings)
+        self.assertIsNot(compiled, compiled_changed)
+        self.assertEqual(compiled_changed['Linear'].class_path, 'narchi.instantiators.pytorch_packed.Linear1dPacked')
+
+        mappings['Missing'] = {'class': 'not_a_module.Missing'}
+        compile_mappings(mappings)
+        mappings['Invalid'] = {'kwargs': {}}
+        self.assertRaises(ValidationError, lambda: compile_mappings(mappings))
+
+
+    def test_sharded_state_dict(self):
+        tmpdir = tempfile.mkdtemp(prefix='_narchi_test_')
+        shards_dir = os.path.join(tmpdir, 'shards')
+        module = StandardModule(laia_jsonnet, cfg=laia_cfg)
+        module.eval()
+        module.save_sharded_state_dict(shards_dir)
+        self.assertEqual(sorted(os.listdir(shards_dir)), ['conv1.pth', 'conv2.pth', 'conv3.pth', 'conv4.pth', 'fc.pth', 's3blstm.pth'])
+        legacy_path = os.path.join(tmpdir, 'legacy.pth')
+        torch.save(module.state_dict(), legacy_path, _use_new_zipfile_serialization=False)
+
+        image = torch.rand(1, 3, 64, 64)
+        with torch.no_grad():
+            logits = module(image=image)
+            for state_dict, meta in [(shards_dir, False), (shards_dir, True), (legacy_path, False)]:
+                module2 = StandardModule(laia_jsonnet, cfg=laia_cfg, state_dict=state_dict, meta=meta)
+                module2.eval()
+                self.assertTrue(torch.equal(logits, module2(image=image)))
+
+        os.remove(os.path.join(shards_dir, 'fc.pth'))
+        self.assertRaises(RuntimeError, lambda: StandardModule(laia_jsonnet, cfg=laia_cfg, state_dict=shards_dir))
+        torch.save({'weight': torch.zeros(1)}, os.path.join(shards_dir, 'fc.pth'))
+        self.assertRaises(RuntimeError, lambda: StandardModule(laia_jsonnet, cfg=laia_cfg, state_dict=shards_dir))
+
+        shutil.rmtree(tmpdir)
+
+
+    def test_load_blocks_state_dict(self):
+        tmpdir = tempfile.mkdtemp(prefix='_narchi_test_')
+        resnet18 = StandardModule(resnet_jsonnet, cfg={'ext_vars': {'num_blocks': [2, 2, 2, 2]}})
+        resnet34 = StandardModule(resnet_jsonnet, cfg={'ext_vars': {'num_blocks': [3, 4, 6, 3]}})
+        checkpoint = os.path.join(tmpdir, 'resnet18.pth')
+        torch.save(resnet18.state_dict(), checkpoint)
+
+        result = resnet34.load_blocks_state_dict(checkpoint, ['conv1', 'layer1·*·conv?'])
+        self.assertEqual(result.loaded, ['conv1', 'layer1·0·conv1', 'layer1·0·conv2', 'layer1·1·conv1', 'layer1·1·conv2'])
+        self.assertEqual(result.missing, ['layer1·2·conv1', 'layer1·2·conv2'])
+        self.assertEqual(result.unexpected, [])
+        self.assertTrue(torch.equal(resnet34.conv1.weight, resnet18.conv1.weight))
+        self.assertFalse(torch.equal(resnet34.layer2[0].conv1.weight, resnet18.layer2[0].conv1.weight))
+
+        result = resnet34.load_blocks_state_dict(checkpoint, ['layer4·2'], remap={'layer4·2': 'layer4·1'})
+        self.assertEqual(result.missing, [])
+        self.assertTrue(torch.equal(resnet34.layer4[2].conv2.weight, resnet18.layer4[1].conv2.weight))
+
+        result = resnet18.load_blocks_state_dict(resnet34.state_dict(), ['layer1'])
+        self.assertEqual(result.missing, [])
+        self.assertEqual(len(result.unexpected), 12)
+        self.assertTrue(all(k.startswith('layer1.2.') for k in result.unexpected))
+
+        multiscale = StandardModule(resnet_multiscale_jsonnet)
+        result = multiscale.load_blocks_state_dict(checkpoint, ['resnet1'], remap={'resnet1': ''})
+        self.assertEqual(result.missing, [])
+        self.assertEqual(result.unexpected, [])
+        self.assertTrue(torch.equal(multiscale.resnet1.conv1.weight, resnet18.conv1.weight))
+        self.assertTrue(torch.equal(multiscale.resnet3.fc.weight, resnet18.fc.weight))
+
+        result = resnet34.load_blocks_state_dict(multiscale.state_dict(), ['layer1·0', 'fc'], remap={'': 'resnet1'})
+        self.assertEqual(result.missing, [])
+        self.assertTrue(torch.equal(resnet34.layer1[0].conv1.weight, resnet18.layer1[0].conv1.weight))
+        self.assertTrue(torch.equal(resnet34.fc.weight, resnet18.fc.weight))
+
+        source = dict(resnet18.state_dict(), stray=torch.zeros(1))
+        resnet34.register_buffer('stray', torch.ones(1))
+        result = resnet34.load_blocks_state_dict(source, ['*'])
+        self.assertEqual(result.unexpected, [])
+        self.assertEqual(resnet34.stray.item(), 1)
+        result = multiscale.load_blocks_state_dict(source, ['resnet1'], remap={'resnet1': ''})
+        self.assertEqual(result.missing, [])
+        self.assertEqual(result.unexpected, ['stray'])
+
+        self.assertRaises(ValueError, lambda: resnet18.load_blocks_state_dict(checkpoint, ['layer5']))
+        shutil.rmtree(tmpdir)
+
+
+    def test_seeded_init(self):
+        resnet18_cfg = {'ext_vars': {'num_blocks': [2, 2, 2, 2]}}
+        resnet34_cfg = {'ext_vars': {'num_blocks': [3, 4, 6, 3]}}
+        state_dict = StandardModule(resnet_jsonnet, cfg=resnet18_cfg, init_seed=3).state_dict()
+        state_dict_threads = StandardModule(resnet_jsonnet, cfg=resnet18_cfg, init_seed=3, init_threads=4).state_dict()
+        self.assertEqual(list(state_dict.keys()), list(state_dict_threads.keys()))
+        self.assertTrue(all(torch.equal(v, state_dict_threads[k]) for k, v in state_dict.items()))
+
+        state_dict_other = StandardModule(resnet_jsonnet, cfg=resnet18_cfg, init_seed=4).state_dict()
+        self.assertFalse(torch.equal(state_dict['conv1.weight'], state_dict_other['conv1.weight']))
+
+        resnet34 = StandardModule(resnet_jsonnet, cfg=resnet34_cfg, init_seed=3, init_threads=2)
+        self.assertTrue(torch.equal(state_dict['conv1.weight'], resnet34.conv1.weight))
+        self.assertTrue(torch.equal(state_dict['fc.weight'], resnet34.fc.weight))
+
+        with torch.no_grad():
+            module = StandardModule(text_image_jsonnet, cfg=text_image_cfg, init_seed=0)
+            module_threads = StandardModule(text_image_jsonnet, cfg=text_image_cfg, init_seed=0, init_threads=3)
+            inputs = module.random_inputs({'L': 32, 'H': 64, 'W': 64})
+            module.eval()
+            module_threads.eval()
+            self.assertTrue(torch.equal(module(**inputs)[0], module_threads(**inputs)[0]))
+
+
+    def test_state_dict_skips_init(self):
+        module = StandardModule(laia_jsonnet, cfg=laia_cfg)
+        module.eval()
+        init_devices = []
+        kaiming_uniform_ = torch.nn.init.kaiming_uniform_
+
+        def kaiming_uniform_spy(tensor, *args, **kwargs):
+            init_devices.append(tensor.device.type)
+            return kaiming_uniform_(tensor, *args, **kwargs)
+
+        with mock.patch('torch.nn.init.kaiming_uniform_', kaiming_uniform_spy):
+            module2 = StandardModule(laia_jsonnet, cfg=laia_cfg, state_dict=module.state_dict())
+        module2.eval()
+        self.assertGreater(len(init_devices), 0)
+        self.assertEqual(set(init_devices), {'meta'})
+        self.assertFalse(module2.is_meta)
+
+        image = torch.rand(1, 3, 64, 64)
+        with torch.no_grad():
+            self.assertTrue(torch.equal(module(image=image), module2(image=image)))
+
+        mappings = dict(standard_pytorch_blocks_mappings)
+        mappings['ReLU'] = {'class': f'{__name__}.ScaledReLU'}
+
+        class ScaledModule(BaseModule):
+            blocks_mappings = mappings
+
+        module = ScaledModule(resnet_jsonnet, cfg=resnet_cfg)
+        module.eval()
+        init_devices.clear()
+        with mock.patch('torch.nn.init.kaiming_uniform_', kaiming_uniform_spy):
+            module2 = ScaledModule(resnet_jsonnet, cfg=resnet_cfg, state_dict=module.state_dict())
+        module2.eval()
+        self.assertEqual(set(init_devices), {'meta'})
+        self.assertTrue(torch.equal(module2.layer1[0].relu1.scale, torch.full((1,), 2.0)))
+        with torch.no_grad():
+            self.assertTrue(torch.equal(module(image=image), module2(image=image)))
+
+
     def test_text_image_classification(self):
         with torch.no_grad():
             module = StandardModule(text_image_jsonnet, cfg=text_image_cfg)
@@ -146,6 +528,53 @@ class PytorchTests(unittest.TestCase):
             self.assertEqual([list(p.shape) for p in logits], [[1, 16], [1, 3]])
 
 
+    def test_branch_threads(self):
+        text = torch.randint(0, 100, (1, 512))
+        image = torch.rand(1, 3, 128, 128)
+        module = StandardModule(text_image_jsonnet, cfg=text_image_cfg, debug=True)
+        module.eval()
+        module_threads = StandardModule(text_image_jsonnet, cfg=text_image_cfg, debug=True, branch_threads=3, state_dict=module.state_dict())
+        module_threads.eval()
+        self.assertTrue(all(m.branch_threads == 3 for m in module_threads.modules() if hasattr(m, 'topological_predecessors')))
+
+        with torch.no_grad():
+            logits = module(text=text, image=image)
+            logits_threads = module_threads(text=text, image=image)
+        self.assertTrue(all(torch.equal(l1, l2) for l1, l2 in zip(logits, logits_threads)))
+        self.assertFalse(logits_threads[0].requires_grad)
+        self.assertEqual(list(module.intermediate_outputs.keys()), list(module_threads.intermediate_outputs.keys()))
+
+        logits_threads = module_threads(text=text, image=image)
+        self.assertTrue(logits_threads[0].requires_grad)
+        self.assertRaises(ValueError, lambda: module_threads.set_branch_threads(0))
+
+        with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16):
+            logits = module(text=text, image=image)
+            logits_threads = module_threads(text=text, image=image)
+        self.assertEqual(logits_threads[0].dtype, torch.bfloat16)
+        self.assertTrue(all(l1.dtype == l2.dtype and torch.equal(l1, l2) for l1, l2 in zip(logits, logits_threads)))
+
+        executor = get_branch_executor(module_threads)
+        module_threads.set_branch_threads(2)
+        self.assertTrue(executor._shutdown)
+        self.assertIsNot(get_branch_executor(module_threads), executor)
+        executor = weakref.ref(get_branch_executor(module_threads))
+        del module_threads
+        gc.collect()
+        self.assertIsNone(executor())
+
+        # Graphs with shared blocks run sequentially in training mode #
+        module = StandardModule(resnet_multiscale_jsonnet, branch_threads=3)
+        self.assertTrue(module.has_shared_blocks)
+        image = torch.rand(2, 3, 64, 64)
+        with mock.patch(f'{BaseModule.__module__}.get_branch_executor', wraps=get_branch_executor) as get_executor:
+            module(image=image)
+            self.assertNotIn(module, [c.args[0] for c in get_executor.call_args_list])
+            module.eval()
+            module(image=image)
+            self.assertIn(module, [c.args[0] for c in get_executor.call_args_list])
+
+
     def test_laia(self):
         tmpdir = tempfile.mkdtemp(prefix='_narchi_test_')
         state_dict_path = os.path.join(tmpdir, 'laia.pth')
@@ -183,10 +612,121 @@ class PytorchTests(unittest.TestCase):
         shutil.rmtree(tmpdir)
 
 
+    def test_meta(self):
+        with torch.no_grad():
+            module = StandardModule(laia_jsonnet, cfg=laia_cfg, meta=True)
+            self.assertTrue(module.is_meta)
+            self.assertTrue(all(p.is_meta for p in module.parameters()))
+            module2 = StandardModule(laia_jsonnet, cfg=laia_cfg)
+            module2.eval()
+            self.assertFalse(module2.is_meta)
+            self.assertEqual(module.state_dict().keys(), module2.state_dict().keys())
+            self.assertEqual(sum(p.numel() for p in module.parameters()), sum(p.numel() for p in module2.parameters()))
+            image = torch.rand(2, 3, 64, 128)
+            logits = module(image=image)
+            self.assertTrue(logits.is_meta)
+            self.assertEqual(list(logits.shape), [2, 16, laia_ext_vars['num_symbols']])
+
+            # Check materialize from state_dict #
+            module.materialize(state_dict=module2.state_dict())
+            module.eval()
+            self.assertFalse(module.is_meta)
+            self.assertTrue(torch.all(module(image=image).eq(module2(image=image))))
+
+            # Check materialize with initialization #
+            module = StandardModule(laia_jsonnet, cfg=laia_cfg, meta=True)
+            module.materialize()
+            self.assertFalse(module.is_meta)
+            self.assertTrue(all(torch.isfinite(p).all() for p in module.parameters()))
+            module.eval()
+            self.assertFalse(module(image=image).is_meta)
+
+            # Check state_dict on meta module #
+            module = StandardModule(laia_jsonnet, cfg=laia_cfg, meta=True, state_dict=module2.state_dict())
+            self.assertFalse(module.is_meta)
+
+
+    def test_checkpointing(self):
+        def run(module, image):
+            num_saved = [0]
+
+            def pack_hook(tensor):
+                num_saved[0] += tensor.numel()
+                return tensor
+
+            with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda x: x):
+                loss = module(image=image).sum()
+            loss.backward()
+            grads = [p.grad.clone() for p in module.parameters()]
+            return num_saved[0], grads
+
+        image = torch.rand(2, 3, 64, 128)
+        module = StandardModule(laia_jsonnet, cfg=laia_cfg)
+        module.eval()
+        saved, grads = run(module, image)
+
+        architecture = ModuleArchitecture(laia_jsonnet, cfg=laia_cfg)
+        architecture.blocks['conv1']._checkpoint = True
+        for checkpoint_blocks in [['conv2', 'conv3', 'conv4'], ['Sequential']]:
+            with self.subTest(checkpoint_blocks):
+                module_ckpt = StandardModule(architecture, cfg=laia_cfg, checkpoint_blocks=checkpoint_blocks, state_dict=module.state_dict())
+                module_ckpt.eval()
+                self.assertEqual([m.checkpointed for m in module_ckpt.modules() if hasattr(m, 'checkpointed')], [True]*4)
+                saved_ckpt, grads_ckpt = run(module_ckpt, image)
+                self.assertLess(saved_ckpt, saved)
+                self.assertTrue(all(torch.allclose(g1, g2, atol=1e-6) for g1, g2 in zip(grads, grads_ckpt)))
+
+        self.assertRaises(ValueError, lambda: StandardModule(laia_jsonnet, cfg=laia_cfg, checkpoint_blocks=['conv5']))
+
+
     def test_packed_blocks(self):
         widths = [128, 96, 64]
         images = [torch.rand(3, 64, widths[0]), torch.rand(3, 64, widths[1]), torch.rand(3, 64, widths[2])]
 
+        # pack_2d_sequences #
+        packed_images = pack_2d_sequences([x[:, :, :w] for x, w in zip(images, [45, 30, 7])], gap_size=3, length_fact=4)
+        self.assertEqual(list(packed_images.lengths), [45, 30, 7])
+        self.assertEqual(list(packed_images.gaps), [3, 6, 1])
+        offset = 0
+        for image, length, gap in zip(images, packed_images.lengths, packed_images.gaps):
+            self.assertTrue(torch.equal(packed_images.data[0, :, :, offset:offset+length], image[:, :, :length]))
+            self.assertTrue(torch.all(packed_images.data[0, :, :, offset+length:offset+length+gap] == 0))
+            offset += length + gap
+        self.assertEqual(packed_images.gaps_index.tolist(), [45, 46, 47, 78, 79, 80, 81, 82, 83, 91])
+        self.assertIsNone(pack_2d_sequences(images).gaps_index)
+
+        # Backward through pack_2d_sequences #
+        for row_width, shared_memory in [(None, False), (170, False), (None, True)]:
+            grad_images = [x.clone().requires_grad_() for x in images]
+            packed = pack_2d_sequences(grad_images, gap_size=4, length_fact=4, row_width=row_width, shared_memory=shared_memory)
+            packed.data.sum().backward()
+            self.assertTrue(all(torch.equal(x.grad, torch.ones_like(x)) for x in grad_images))
+
+        # packed_2d_to_1d #
+        packed_1d = packed_2d_to_1d(packed_images)
+        self.assertEqual(packed_1d.batch_sizes.tolist(), [3]*7+[2]*23+[1]*15)
+        padded, lengths = pad_packed_sequence(packed_1d)
+        self.assertEqual(lengths.tolist(), [45, 30, 7])
+        offset = 0
+        for num, (length, gap) in enumerate(zip(packed_images.lengths, packed_images.gaps)):
+            expected = packed_images.data[0, :, :, offset:offset+length].reshape(-1, length).t()
+            self.assertTrue(torch.equal(padded[:length, num, :], expected))
+            offset += length + gap
+        self.assertIs(packed_2d_to_1d(packed_images).batch_sizes, packed_1d.batch_sizes)
+
+        # Multi-row packing #
+        packed_rows = pack_2d_sequences(images, gap_size=4, length_fact=4, row_width=170)
+        self.assertEqual(list(packed_rows.data.shape), [2, 3, 64, 172])
+        self.assertEqual(list(packed_rows.rows), [0, 1, 1])
+        self.assertEqual(list(packed_rows.gaps), [44, 4, 8])
+        self.assertTrue(torch.equal(packed_rows.data[1, :, :, 100:164], images[2]))
+        self.assertTrue(torch.all(packed_rows.data[0, :, :, 128:] == 0))
+        pooled = MaxPool2dPacked(kernel_size=4, stride=4)(packed_rows)
+        self.assertEqual(list(pooled.data.shape), [2, 3, 16, 43])
+        self.assertEqual(list(pooled.gaps), [11, 1, 2])
+        packed_1d_rows = packed_2d_to_1d(packed_rows)
+        self.assertTrue(torch.equal(packed_1d_rows.data, packed_2d_to_1d(pack_2d_sequences(images, gap_size=4)).data))
+
         # Conv2dPacked #
         block = Conv2dPacked(in_channels=3, out_channels=5, kernel_size=7, padding=3)
         packed_images = pack_2d_sequences(images, gap_size=1, length_fact=1)
@@ -200,10 +740,108 @@ class PytorchTests(unittest.TestCase):
         packed_images = pack_2d_sequences(images, gap_size=1, length_fact=1)
         self.assertRaises(RuntimeError, lambda: block(packed_images))
         packed_images = pack_2d_sequences(images, gap_size=4, length_fact=4)
-        block(packed_images)
+        pooled = block(packed_images)
+        self.assertEqual(list(pooled.lengths), [32, 24, 16])
+        self.assertEqual(list(pooled.gaps), [1, 1, 0])
         self.assertRaises(NotImplementedError, lambda: MaxPool2dPacked(kernel_size=4, stride=2))
 
 
+    def test_text_tagger_packed(self):
+        with torch.no_grad():
+            module = PackedModule(text_tagger_jsonnet, cfg=text_tagger_cfg)
+            module.eval()
+            module2 = StandardModule(text_tagger_jsonnet, cfg=text_tagger_cfg, state_dict=module.state_dict())
+            module2.eval()
+            texts = [torch.randint(0, 100, (length,)) for length in [7, 19, 3, 12]]
+            tags_packed = module(text=texts)
+            self.assertIsInstance(tags_packed, PackedSequence)
+            tags, lengths = pad_packed_sequence(tags_packed, batch_first=True)
+            self.assertEqual(lengths.tolist(), [7, 19, 3, 12])
+            for num, text in enumerate(texts):
+                with self.subTest(f'text {num}'):
+                    tags2 = module2(text=text.unsqueeze(0))
+                    self.assertTrue(torch.allclose(tags2[0], tags[num, :lengths[num]], atol=1e-6))
+
+            tags_unpacked = unpack_sequences(tags_packed)
+            self.assertTrue(all(torch.equal(tags_unpacked[n], tags[n, :lengths[n]]) for n in range(len(texts))))
+            tags_padded, lengths_padded = unpack_sequences(tags_packed, padded=True)
+            self.assertTrue(torch.equal(tags_padded, tags))
+
+            self.assertRaises(RuntimeError, lambda: ReshapePacked('flatten')(tags_packed))
+            texts_packed = pack_sequence([torch.rand(n, 3) for n in [9, 4]])
+            for kwargs in [{'padding': 0}, {'padding': 1, 'stride': 2}, {'padding': 2, 'dilation': 2}, {'padding': 1, 'padding_mode': 'reflect'}]:
+                with self.subTest(kwargs):
+                    conv = Conv1dPacked(in_channels=3, out_channels=5, kernel_size=3, **kwargs)
+                    self.assertEqual(conv(torch.rand(1, 3, 9)).shape[1], 5)
+                    self.assertRaises(NotImplementedError, lambda: conv(texts_packed))
+
+            module = PackedModule(dict_to_namespace({
+                '_id': 'StridedConv',
+                'blocks': [{'_class': 'Conv1d', '_id': 'conv', 'output_feats': 5, 'kernel_size': 3, 'padding': 1, 'stride': 2}],
+                'graph': ['feats -> conv -> output'],
+                'inputs': [{'_id': 'feats', '_shape': [3, 16]}],
+                'outputs': [{'_id': 'output', '_shape': [5, 8]}],
+            }))
+            self.assertEqual(module.conv.stride, (2,))
+            self.assertEqual(module(feats=torch.rand(1, 3, 16)).shape, (1, 5, 8))
+
+
+    def test_ctc_decode(self):
+        log_probs = [torch.randn(length, 6).log_softmax(-1) for length in [30, 7, 50, 1, 22]]
+        packed = pack_sequence(log_probs, enforce_sorted=False)
+
+        def greedy_loop(x, blank=0):
+            best = x.argmax(-1).tolist()
+            return [c for t, c in enumerate(best) if c != blank and (t == 0 or c != best[t-1])]
+
+        self.assertEqual(ctc_greedy_decode(packed), [greedy_loop(x) for x in log_probs])
+        self.assertEqual(ctc_greedy_decode(packed, blank=5), [greedy_loop(x, blank=5) for x in log_probs])
+
+        # Beam search finds the most probable labeling, which greedy misses #
+        two_frames = torch.tensor([[0.6, 0.4], [0.6, 0.4]]).log()
+        self.assertEqual(ctc_greedy_decode(pack_sequence([two_frames])), [[]])
+        self.assertEqual(ctc_beam_decode(pack_sequence([two_frames]), beam_size=2), [[1]])
+
+        decoded = ctc_beam_decode(packed, beam_size=8)
+        self.assertEqual(len(decoded), len(log_probs))
+        self.assertEqual(decoded, ctc_beam_decode(packed, beam_size=8, num_workers=2))
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(decoded, ctc_beam_decode(packed, beam_size=8, executor=executor))
+
+
+    def test_packed_batch_sampler(self):
+        widths = [70, 300, 120, 64, 250, 90, 400, 33]
+        sampler = PackedBatchSampler(widths, max_pixels=64*512, height=64, gap_size=4, length_fact=8)
+        batches = list(sampler)
+        self.assertEqual(batches, [[6], [1], [4, 2, 5], [0, 3, 7]])
+        self.assertEqual(len(sampler), 4)
+        self.assertTrue(all(packed_2d_length(np.array(widths)[b], 4, 8) <= 512 for b in batches))
+        self.assertAlmostEqual(sampler.efficiency, sum(widths)/(400+304+480+192))
+
+        sampler = PackedBatchSampler(widths, max_pixels=64*512, height=64, gap_size=4, length_fact=8, shuffle=True)
+        batches = list(sampler)
+        self.assertEqual(sorted(sum(batches, [])), list(range(len(widths))))
+        self.assertTrue(all(sorted(b, key=lambda n: -widths[n]) == b for b in batches))
+        self.assertEqual(batches, list(sampler))
+
+        dataset = [(torch.rand(3, 64, w), n) for n, w in enumerate(widths)]
+        loader = torch.utils.data.DataLoader(dataset, batch_sampler=sampler, collate_fn=PackedCollate())
+        for images, targets in loader:
+            self.assertEqual([x.shape[2] for x in images], [widths[n] for n in targets.tolist()])
+            pack_2d_sequences(images, gap_size=4, length_fact=8)
+
+        with torch.no_grad():
+            module = PackedModule(laia_jsonnet, cfg=laia_cfg, gap_size=4, length_fact=8)
+            module.eval()
+            collate = PackedCollate(pack=True, gap_size=4, length_fact=8)
+            loader = torch.utils.data.DataLoader(dataset, batch_sampler=sampler, collate_fn=collate, num_workers=1)
+            for packed, targets in loader:
+                self.assertIsInstance(packed, Packed2dSequence)
+                self.assertTrue(packed.data.is_shared())
+                images = [dataset[n][0] for n in targets.tolist()]
+                self.assertTrue(torch.equal(module(image=packed).data, module(image=images).data))
+
+
     def test_laia_packed(self):
         with torch.no_grad():
             # Check standard and packed give same result #
@@ -223,6 +861,13 @@ class PytorchTests(unittest.TestCase):
                     self.assertEqual(lengths[num], logits2.shape[1])
                     self.assertTrue(torch.allclose(logits2[0,:,:], logits[num,:lengths[num],:], atol=1e-7))
 
+            # Check multi-row packing gives same result #
+            module2 = PackedModule(laia_jsonnet, cfg=laia_cfg, gap_size=4, length_fact=8, row_width=160, state_dict=module.state_dict())
+            module2.eval()
+            logits_rows = module2(image=images)
+            self.assertTrue(torch.equal(logits_packed.batch_sizes, logits_rows.batch_sizes))
+            self.assertTrue(torch.allclose(logits_packed.data, logits_rows.data, atol=1e-6))
+
             # Check instantiation from object #
             module2 = ModuleArchitecture(laia_jsonnet, cfg=laia_cfg)
             module2 = PackedModule(module2, gap_size=4, length_fact=8, state_dict=module.state_dict())
@@ -255,8 +900,18 @@ class PytorchTests(unittest.TestCase):
             unsorted_images = [images[n] for n in [1, 2, 0]]
             packed = pack_2d_sequences(unsorted_images, fail_if_unsorted=False)
             self.assertEqual(list(packed.lengths), widths)
+            self.assertEqual(list(packed.sorted_indices), [2, 0, 1])
             self.assertRaises(ValueError, lambda: module(image=unsorted_images))
 
+            # Check unpacking to original order #
+            packed = pack_2d_sequences(unsorted_images, gap_size=4, length_fact=8, fail_if_unsorted=False)
+            logits_unsorted = unpack_sequences(module(image=packed))
+            logits_sorted = unpack_sequences(module(image=images))
+            for num, image in enumerate(unsorted_images):
+                with self.subTest(f'unsorted image {num}'):
+                    self.assertEqual(logits_unsorted[num].shape[0], image.shape[2]//8)
+                    self.assertTrue(torch.allclose(logits_unsorted[num], logits_sorted[[1, 2, 0][num]], atol=1e-6))
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
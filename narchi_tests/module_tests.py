@@ -5,7 +5,7 @@ import os
 import shutil
 import tempfile
 import unittest
-from jsonargparse import ParserError
+from jsonargparse import ParserError, dict_to_namespace
 from jsonschema.exceptions import ValidationError
 from narchi.module import ModuleArchitecture
 from narchi.blocks import propagators
@@ -122,5 +122,43 @@ class ModuleArchitectureTests(unittest.TestCase):
         self.assertEqual({'in': [128], 'out': [16]}, vars(module.architecture._shape))
 
 
+    def test_shared_blocks(self):
+        module = ModuleArchitecture(resnet_multiscale_jsonnet)
+        shapes = [b._shape for b in module.architecture.blocks if hasattr(b, '_id_share')]
+        self.assertEqual(getattr(shapes[1], 'in'), [3, '<<variable:H/2>>', '<<variable:W/2>>'])
+        self.assertEqual([s.out for s in shapes], [[1000]]*3)
+
+        cfg = dict(laia_cfg)
+        cfg['propagate'] = False
+        for ids in [['conv2', 'conv3'], ['s3blstm', 'fc']]:
+            with self.subTest(ids):
+                module = ModuleArchitecture(laia_jsonnet, cfg=cfg)
+                for block in module.architecture.blocks:
+                    if block._id in ids:
+                        block._id_share = 'shared'
+                self.assertRaises(ValueError, lambda: module.propagate())
+
+        for kernel_size, padding in [(3, 1), (5, 2)]:
+            with self.subTest(kernel_size):
+                architecture = dict_to_namespace({
+                    '_id': 'SharedConvs',
+                    'blocks': [
+                        {'_class': 'Conv2d', '_id': 'conv1', '_id_share': 'conv', 'output_feats': 3, 'kernel_size': 3, 'padding': 1},
+                        {'_class': 'Conv2d', '_id': 'conv2', '_id_share': 'conv', 'output_feats': 3, 'kernel_size': kernel_size, 'padding': padding},
+                    ],
+                    'graph': ['image -> conv1 -> conv2 -> output'],
+                    'inputs': [{'_id': 'image', '_shape': [3, 16, 16]}],
+                    'outputs': [{'_id': 'output', '_shape': [3, 16, 16]}],
+                })
+                if kernel_size == 3:
+                    ModuleArchitecture(architecture)
+                else:
+                    self.assertRaisesRegex(ValueError, 'same attributes', lambda: ModuleArchitecture(architecture))
+
+        module = ModuleArchitecture(shared_scope_jsonnet)
+        shapes = [b._shape for b in module.architecture.blocks[2].architecture.blocks if hasattr(b, '_id_share')]
+        self.assertEqual([s.out for s in shapes], [[4]]*2)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
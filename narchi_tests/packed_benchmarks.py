@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Benchmarks for packed sequence conversions, run as: python3 -m narchi_tests.packed_benchmarks"""
+
+import time
+import numpy as np
+import torch
+from torch.nn.utils.rnn import PackedSequence
+from narchi.instantiators.pytorch_packed import Packed2dSequence, pack_2d_sequences, packed_2d_to_1d, packed_2d_to_1d_index
+
+
+def packed_2d_to_1d_loop(packed_2d: Packed2dSequence) -> PackedSequence:
+    """Reference frame by frame implementation of packed_2d_to_1d."""
+    data = packed_2d.data
+    lengths = packed_2d.lengths
+    gaps = packed_2d.gaps
+    data_1d = torch.zeros((lengths.sum(), np.prod(data.shape[1:3])), dtype=data.dtype, device=data.device)
+    offsets = [0]
+    batch_sizes = torch.zeros(lengths[0], dtype=torch.long)
+    for num, length in enumerate(lengths):
+        offsets.append(offsets[num]+length+gaps[num])
+        batch_sizes[0:length] += 1
+    p = 0
+    for t, nsamp in enumerate(batch_sizes):
+        for num in range(nsamp):
+            data_1d[p, :] = data[0, :, :, offsets[num]+t].reshape(-1)
+            p += 1
+    sorted_indices = torch.arange(len(lengths), dtype=torch.long, device=data.device)
+    return PackedSequence(data_1d, batch_sizes, sorted_indices, sorted_indices)
+
+
+def benchmark(function, packed, repeats):
+    function(packed)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function(packed)
+    return (time.perf_counter()-start)/repeats
+
+
+def main():
+    torch.manual_seed(0)
+    for num_samples, channels, height, max_width in [(16, 64, 4, 256), (128, 64, 4, 256), (256, 128, 2, 512)]:
+        widths = sorted(torch.randint(max_width//4, max_width, (num_samples,)).tolist(), reverse=True)
+        packed = pack_2d_sequences([torch.rand(channels, height, w) for w in widths], gap_size=2)
+        assert torch.equal(packed_2d_to_1d(packed).data, packed_2d_to_1d_loop(packed).data)
+        loop = benchmark(packed_2d_to_1d_loop, packed, repeats=1)
+        packed_2d_to_1d_index.cache_clear()
+        uncached = benchmark(lambda x: (packed_2d_to_1d_index.cache_clear(), packed_2d_to_1d(x)), packed, repeats=10)
+        cached = benchmark(packed_2d_to_1d, packed, repeats=10)
+        print(f'samples={num_samples} frames={sum(widths)} feats={channels*height}: loop={loop*1e3:.1f}ms '
+              f'gather={uncached*1e3:.2f}ms gather_cached={cached*1e3:.2f}ms speedup={loop/cached:.0f}x')
+
+
+if __name__ == '__main__':
+    main()
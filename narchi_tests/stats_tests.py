@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Unit tests for static statistics."""
+
+import unittest
+from narchi.stats import ModuleArchitectureStats
+from narchi_tests.data import *
+
+try:
+    import torch
+except:
+    torch = False
+
+if torch:
+    from narchi.instantiators.pytorch import StandardModule
+
+
+class StatsTests(unittest.TestCase):
+    """Tests for the ModuleArchitectureStats class."""
+
+    def test_laia_stats(self):
+        module = ModuleArchitectureStats(laia_jsonnet, cfg=laia_cfg)
+        rows = module.stats()
+        self.assertEqual([r['id'] for r in rows], [b._id for b in module.architecture.blocks]+['laia'])
+        total = rows[-1]
+        self.assertEqual(total['class'], 'Total')
+        self.assertEqual(total['params'], 4258324)
+        self.assertIn('W', total['macs'])
+        fc = next(r for r in rows if r['id'] == 'fc')
+        self.assertEqual(fc['params'], 512*68+68)
+        self.assertEqual(fc['macs'], '4352*W')
+        self.assertEqual(fc['activations'], '17*W/2')
+
+        rows = module.stats(variables={'W': 128}, nested_depth=0)
+        self.assertIn('conv1·0', [r['id'] for r in rows])
+        fc = next(r for r in rows if r['id'] == 'fc')
+        self.assertEqual(fc['macs'], 4352*128)
+        self.assertEqual(fc['activations'], 16*68)
+        self.assertTrue(all(isinstance(r[k], int) for r in rows for k in ['params', 'macs', 'activations']))
+
+        table = module.stats_table(variables={'W': 128})
+        self.assertEqual(len(table.split('\n')), len(module.architecture.blocks)+2)
+
+
+    def test_memory_plan(self):
+        module = ModuleArchitectureStats(laia_jsonnet, cfg=laia_cfg)
+        plan = module.memory_plan()
+        self.assertEqual(plan['mode'], 'inference')
+        self.assertEqual(plan['peak'], '2240*W')
+        self.assertEqual(plan['alive'], ['image', 'conv1·0', 'conv1·1'])
+
+        plan = module.memory_plan(mode='training', variables={'W': 128})
+        rows = module.stats(variables={'W': 128})
+        self.assertEqual(plan['peak'], 3*64*128 + rows[-1]['activations'])
+        self.assertEqual(plan['alive'], ['image']+[b._id for b in module.architecture.blocks])
+
+        self.assertEqual(module.max_batch_size(2**30, variables={'W': 128}), (2**30-4*4258324)//(4*2240*128))
+        self.assertEqual(module.max_batch_size(2**30, mode='training', bytes_per_element=2, variables={'W': 128}),
+                         (2**30-2*2*4258324)//(2*plan['peak']))
+        self.assertEqual(module.max_batch_size(2**20, variables={'W': 128}), 0)
+        self.assertIn('W', module.max_batch_size(2**30))
+        self.assertRaises(ValueError, lambda: module.max_batch_size())
+        self.assertRaises(ValueError, lambda: module.memory_plan(mode='other'))
+
+        module = ModuleArchitectureStats(resnet_jsonnet, cfg=resnet_cfg)
+        self.assertIsNone(module.memory_plan()['alive'])
+        self.assertEqual(module.memory_plan(variables={'H': 64, 'W': 64})['alive'], ['conv1', 'bn1'])
+
+
+    @unittest.skipIf(not torch, 'torch package is required')
+    def test_params_agree_with_pytorch(self):
+        for jsonnet, cfg in [(laia_jsonnet, laia_cfg), (squeezenet_jsonnet, {}), (text_image_jsonnet, text_image_cfg), (shared_scope_jsonnet, {})]:
+            with self.subTest(jsonnet):
+                params = ModuleArchitectureStats(jsonnet, cfg=cfg).stats()[-1]['params']
+                module = StandardModule(jsonnet, cfg=cfg, meta=True)
+                self.assertEqual(params, sum(p.numel() for p in module.parameters()))
+        self.assertEqual(params, (8*8+8)+(8*4+4)+(4*4+4))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)